@@ -1,45 +1,201 @@
+"""Emails the connect group report
+
+Importing this module is kept cheap, as the report runs in short-lived
+containers: pypco, openpyxl, the email stack and the rest of the package are
+imported by the functions that use them, as each phase of the run starts.
+Logging and .env are set up by main(), not on import.
+"""
+
+import argparse
+import base64
+import io
+import json
 import logging
 import os
 import pathlib
-import smtplib
+import re
+import shutil
 from datetime import date
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from typing import IO, TYPE_CHECKING, Dict, Iterator, List, Optional
 
 import daiquiri
-import pypco
-from dotenv import load_dotenv
-
-load_dotenv()
-
-from inc_cg_reporter.connect_group import PersonManager, ConnectGroupMembershipManager
-from inc_cg_reporter.field_definition import (
-    FieldDataProcessor,
-    CONNECT_GROUP_FIELD_DEFINITION_NAME,
-    PERSONAL_ATTRIBUTE_NAME,
-    PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES,
-    PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES,
-)
-from inc_cg_reporter.excel_writer import (
-    ConnectGroupWorksheetGenerator,
-    ConnectGroupWorkbookManager,
-)
-
-daiquiri.setup(level=logging.INFO)
+
+from inc_cg_reporter.metrics import RunMetrics
+
+if TYPE_CHECKING:
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+
+    import pypco
+
+    from inc_cg_reporter.delivery import DeliveryStats, SMTPPool
+    from inc_cg_reporter.excel_writer import ConnectGroupWorkbookManager
+    from inc_cg_reporter.field_definition import FieldDefinitionCache
+    from inc_cg_reporter.http_cache import HTTPCache
+    from inc_cg_reporter.name_cache import PersonNameCache
+    from inc_cg_reporter.profiling import PhaseProfiler
+    from inc_cg_reporter.sheet_cache import SheetCache
+    from inc_cg_reporter.snapshot import FieldDataSnapshot
+
 logger = daiquiri.getLogger(__name__)
 
+# base64 encodes 57 bytes per 76 character line, so this is whole lines
+ATTACHMENT_CHUNK_BYTES = 57 * 1024
+
+
+def get_pco(http_cache: Optional["HTTPCache"] = None) -> "pypco.PCO":
+    """Returns reuseable Planning Centre Online instance
+
+    All of its requests are sent through a RequestScheduler, so they share
+    PCO's rate limit however many workers are making them. Revalidations by
+    http_cache are scheduled like any other request.
+    """
+    import pypco
+
+    from inc_cg_reporter.scheduler import RequestScheduler
 
-def get_pco() -> pypco.PCO:
-    """Returns reuseable Planning Centre Online instance"""
     app_id = os.environ["PC_APPLICATION_ID"]
     app_secret = os.environ["PC_SECRET"]
-    return pypco.PCO(app_id, app_secret)
+    pco = pypco.PCO(
+        app_id,
+        app_secret,
+        api_base=os.environ.get("PCO_API_BASE", "https://api.planningcenteronline.com"),
+    )
+    if http_cache is not None:
+        http_cache.install(pco)
+    RequestScheduler.install(
+        pco,
+        max_concurrency=int(
+            os.environ.get(
+                "PCO_MAX_CONCURRENCY", str(RequestScheduler.DEFAULT_MAX_CONCURRENCY)
+            )
+        ),
+    )
+    return pco
 
 
-def send_summary_email(saved_file: pathlib.Path):
-    email_from = os.environ["EMAIL_FROM"]
-    email_to = os.environ["EMAIL_TO"]
+def get_cache_dir() -> Optional[pathlib.Path]:
+    """Directory for state kept between runs, or None if caching is disabled"""
+    cache_dir = os.environ.get("CACHE_DIR")
+    return pathlib.Path(cache_dir) if cache_dir else None
+
+
+def get_field_definition_cache() -> Optional["FieldDefinitionCache"]:
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    from inc_cg_reporter.field_definition import FieldDefinitionCache
+
+    return FieldDefinitionCache(
+        cache_dir / "field_definitions.json",
+        int(
+            os.environ.get(
+                "FIELD_DEFINITION_CACHE_TTL",
+                str(FieldDefinitionCache.DEFAULT_TTL_SECONDS),
+            )
+        ),
+    )
+
+
+def get_snapshot() -> Optional["FieldDataSnapshot"]:
+    cache_dir = get_cache_dir()
+    if (
+        cache_dir is None
+        or os.environ.get("INCREMENTAL_SYNC", "false").lower() != "true"
+    ):
+        return None
+    from inc_cg_reporter.snapshot import FieldDataSnapshot
+
+    return FieldDataSnapshot(
+        cache_dir / "snapshot.sqlite3",
+        int(
+            os.environ.get(
+                "FULL_RESYNC_INTERVAL",
+                str(FieldDataSnapshot.DEFAULT_FULL_RESYNC_INTERVAL_SECONDS),
+            )
+        ),
+    )
+
+
+def get_name_cache() -> Optional["PersonNameCache"]:
+    cache_dir = get_cache_dir()
+    if cache_dir is None or os.environ.get("NAME_CACHE", "false").lower() != "true":
+        return None
+    from inc_cg_reporter.name_cache import PersonNameCache
+
+    return PersonNameCache(
+        cache_dir / "person_names.json",
+        int(os.environ.get("NAME_CACHE_TTL", str(PersonNameCache.DEFAULT_TTL_SECONDS))),
+    )
+
+
+def get_http_cache() -> Optional["HTTPCache"]:
+    cache_dir = get_cache_dir()
+    if cache_dir is None or os.environ.get("HTTP_CACHE", "false").lower() != "true":
+        return None
+    from inc_cg_reporter.http_cache import HTTPCache
+
+    return HTTPCache(
+        cache_dir / "http",
+        int(os.environ.get("HTTP_CACHE_MAX_BYTES", str(HTTPCache.DEFAULT_MAX_BYTES))),
+    )
+
+
+def get_sheet_cache() -> Optional["SheetCache"]:
+    cache_dir = get_cache_dir()
+    if cache_dir is None or os.environ.get("SHEET_CACHE", "false").lower() != "true":
+        return None
+    from inc_cg_reporter.sheet_cache import SheetCache
+
+    return SheetCache(cache_dir / "sheets")
+
+
+def get_profiler(
+    directory: Optional[str] = None,
+    modes: Optional[str] = None,
+    phases: Optional[str] = None,
+) -> Optional["PhaseProfiler"]:
+    """A profiler for the run's phases if PROFILE_DIR (or directory) is set
+
+    modes and phases are comma separated, and default to PROFILE_MODES and
+    PROFILE_PHASES.
+    """
+    directory = directory or os.environ.get("PROFILE_DIR")
+    if not directory:
+        return None
+    from inc_cg_reporter.profiling import PhaseProfiler
+
+    modes = modes or os.environ.get("PROFILE_MODES", PhaseProfiler.CPROFILE)
+    phases = phases or os.environ.get("PROFILE_PHASES", "")
+    return PhaseProfiler(
+        pathlib.Path(directory),
+        modes=[mode.strip() for mode in modes.split(",") if mode.strip()],
+        phases=[phase.strip() for phase in phases.split(",") if phase.strip()],
+        top=int(os.environ.get("PROFILE_TOP", "25")),
+        sample_interval=float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.05")),
+    )
+
+
+def build_attachment(workbook: IO[bytes], filename: str) -> "MIMEBase":
+    """What MIMEApplication would make of workbook's contents, but base64
+    encoded a chunk at a time rather than reading all of it first"""
+    from email.mime.base import MIMEBase
+
+    part = MIMEBase("application", "octet-stream")
+    encoded = []
+    while chunk := workbook.read(ATTACHMENT_CHUNK_BYTES):
+        encoded.append(base64.encodebytes(chunk).decode("ascii"))
+    part.set_payload("".join(encoded))
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=filename)
+    return part
+
+
+def build_summary_email(
+    workbook: IO[bytes], email_from: str, email_to: str
+) -> "MIMEMultipart":
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
 
     msg = MIMEMultipart()
     msg["Subject"] = "INC CG report"
@@ -55,48 +211,220 @@ def send_summary_email(saved_file: pathlib.Path):
         "plain",
     )
     msg.attach(body)
+    msg.attach(build_attachment(workbook, f"inc_cg-{current_datestamp}.xlsx"))
+    return msg
 
-    with open(saved_file, "rb") as attachment:
-        part = MIMEApplication(attachment.read())
-        part.add_header(
-            "Content-Disposition",
-            "attachment",
-            filename=f"inc_cg-{current_datestamp}.xlsx",
-        )
-    msg.attach(part)
 
-    smtp_host = os.environ["SMTP_HOST"]
-    smtp_port = int(os.environ["SMTP_PORT"])
-    smtp_username = os.environ["SMTP_USERNAME"]
-    smtp_password = os.environ["SMTP_PASSWORD"]
+def send_summary_email(workbook: IO[bytes], smtp_pool: "SMTPPool") -> "DeliveryStats":
+    """Sends the full report to EMAIL_TO
 
-    with smtplib.SMTP(smtp_host, smtp_port) as server:
-        server.starttls()
-        server.login(smtp_username, smtp_password)
-        server.sendmail(email_from, [email_to], msg.as_string())
+    Unlike the leaders' emails, the run fails (RuntimeError) if this can't
+    be delivered, retries and all.
+    """
+    from inc_cg_reporter.delivery import deliver
+
+    email_from = os.environ["EMAIL_FROM"]
+    email_to = os.environ["EMAIL_TO"]
+    msg = build_summary_email(workbook, email_from, email_to)
+    stats = deliver(smtp_pool, [msg], get_smtp_max_attempts())
+    if not stats.sent:
+        raise RuntimeError(f"Unable to send the report email to {email_to}")
     logger.info("Email sent to %s", email_to)
+    return stats
 
 
-def run() -> None:
-    logger.info("Starting...")
-    pco = get_pco()
-    person_manager = PersonManager()
-    connect_group_person_manager = ConnectGroupMembershipManager(person_manager)
-    # Pull date and membership data from Planning Centre, populating the person
-    #  and connect group person manager instances
-    field_data_processor = FieldDataProcessor(
-        pco,
+def get_smtp_pool() -> "SMTPPool":
+    from inc_cg_reporter.delivery import SMTPPool
+
+    return SMTPPool(
+        os.environ["SMTP_HOST"],
+        int(os.environ["SMTP_PORT"]),
+        os.environ.get("SMTP_USERNAME"),
+        os.environ.get("SMTP_PASSWORD"),
+        size=int(os.environ.get("SMTP_POOL_SIZE", str(SMTPPool.DEFAULT_SIZE))),
+        starttls=os.environ.get("SMTP_STARTTLS", "true").lower() == "true",
+    )
+
+
+def get_smtp_max_attempts() -> int:
+    return int(os.environ.get("SMTP_MAX_ATTEMPTS", "3"))
+
+
+def get_leader_emails() -> Optional[Dict[str, List[str]]]:
+    """Connect group name -> its leaders' email addresses, from a JSON object
+    in LEADER_EMAILS_FILE whose values are an address or a list of them"""
+    leader_emails_file = os.environ.get("LEADER_EMAILS_FILE")
+    if not leader_emails_file:
+        return None
+    leader_emails = json.loads(pathlib.Path(leader_emails_file).read_text())
+    return {
+        group: [addresses] if isinstance(addresses, str) else list(addresses)
+        for group, addresses in leader_emails.items()
+    }
+
+
+def build_leader_email(
+    group_name: str, workbook: bytes, email_from: str, email_to: List[str]
+) -> "MIMEMultipart":
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart()
+    msg["Subject"] = f"INC CG report - {group_name}"
+    msg["From"] = email_from
+    msg["To"] = ", ".join(email_to)
+
+    current_datestamp = date.today().strftime("%Y-%m-%d")
+    file_group_name = re.sub(r"[^\w-]+", "_", group_name)
+
+    body = MIMEText(
+        f"Current {group_name} spreadsheet attached.\n"
+        "Reply to this email if you have questions.\n"
+        "--Edwin",
+        "plain",
+    )
+    msg.attach(body)
+    msg.attach(
+        build_attachment(
+            io.BytesIO(workbook),
+            f"inc_cg-{file_group_name}-{current_datestamp}.xlsx",
+        )
+    )
+    return msg
+
+
+def send_leader_emails(
+    workbook_manager: "ConnectGroupWorkbookManager",
+    leader_emails: Dict[str, List[str]],
+    smtp_pool: "SMTPPool",
+) -> "DeliveryStats":
+    """Sends each connect group's leaders a workbook of just their group's
+    sheet, rendering the workbooks while earlier ones are being sent"""
+    from inc_cg_reporter.delivery import deliver
+
+    email_from = os.environ["EMAIL_FROM"]
+    matched: set[str] = set()
+
+    def messages() -> Iterator["MIMEMultipart"]:
+        for cg, workbook in workbook_manager.group_workbooks(leader_emails):
+            matched.add(cg.name)
+            yield build_leader_email(
+                cg.name, workbook, email_from, leader_emails[cg.name]
+            )
+
+    stats = deliver(smtp_pool, messages(), get_smtp_max_attempts())
+    for group in sorted(set(leader_emails) - matched):
+        logger.warning(
+            "%r in LEADER_EMAILS_FILE isn't a connect group with members, so its"
+            " leaders weren't emailed",
+            group,
+        )
+    return stats
+
+
+def write_run_metrics(metrics: RunMetrics) -> None:
+    if run_report_file := os.environ.get("RUN_REPORT_FILE"):
+        metrics.write_json(pathlib.Path(run_report_file))
+    if prometheus_textfile := os.environ.get("PROMETHEUS_TEXTFILE"):
+        metrics.write_prometheus(pathlib.Path(prometheus_textfile))
+
+
+def run(profiler: Optional["PhaseProfiler"] = None) -> None:
+    metrics = RunMetrics(profiler or get_profiler())
+    try:
+        produce_report(metrics)
+        metrics.succeeded = True
+    finally:
+        write_run_metrics(metrics)
+
+
+def produce_report(metrics: RunMetrics) -> None:
+    from inc_cg_reporter.connect_group import (
+        ConnectGroupMembershipManager,
+        PersonManager,
+    )
+    from inc_cg_reporter.field_definition import (
+        FieldDataProcessor,
+        FieldDataQueryPlanner,
         CONNECT_GROUP_FIELD_DEFINITION_NAME,
+        PERSONAL_ATTRIBUTE_NAME,
         PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES,
         PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES,
-        person_manager,
-        connect_group_person_manager,
     )
-    logger.info("Populating person and connect group manager instances")
-    field_data_processor.process()
-    # Pull people's names from Planning Centre
-    logger.info("Pulling people's names and matching with IDs")
-    connect_group_person_manager.populate_names_for_people(pco)
+
+    logger.info("Starting...")
+    http_cache = get_http_cache()
+    pco = get_pco(http_cache)
+    person_manager = PersonManager()
+    connect_group_person_manager = ConnectGroupMembershipManager(person_manager)
+    snapshot = get_snapshot()
+    try:
+        full_resync = snapshot is None or snapshot.begin_sync(
+            force_full=os.environ.get("FULL_RESYNC", "false").lower() == "true"
+        )
+        # Pull date and membership data from Planning Centre, populating the person
+        #  and connect group person manager instances
+        field_data_processor = FieldDataProcessor(
+            pco,
+            CONNECT_GROUP_FIELD_DEFINITION_NAME,
+            PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES,
+            PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES,
+            person_manager,
+            connect_group_person_manager,
+            max_workers=int(os.environ.get("FIELD_DATA_WORKERS", "1")),
+            page_workers=int(os.environ.get("FIELD_DATA_PAGE_WORKERS", "1")),
+            field_definition_cache=get_field_definition_cache(),
+            snapshot=snapshot,
+            full_resync=full_resync,
+            plan=os.environ.get("FIELD_DATA_PLAN", FieldDataQueryPlanner.PER_FIELD),
+            lean=os.environ.get("FIELD_DATA_LEAN", "false").lower() == "true",
+        )
+        logger.info("Populating person and connect group manager instances")
+        with metrics.phase("field_definition_mapping"):
+            field_handler = field_data_processor.build_field_handler()
+        with metrics.phase("field_data_processing"):
+            field_data_processor.process_field_data(field_handler)
+        metrics.record(field_data_records=field_data_processor.records_dispatched)
+        # Pull people's names from Planning Centre
+        logger.info("Pulling people's names and matching with IDs")
+        with metrics.phase("name_population"):
+            known_names = None
+            if snapshot is not None and not full_resync:
+                known_names = snapshot.names()
+                if names_synced_at := snapshot.names_synced_at():
+                    known_names.update(
+                        ConnectGroupMembershipManager.get_names_updated_since(
+                            pco, names_synced_at
+                        )
+                    )
+            name_cache = get_name_cache()
+            connect_group_person_manager.populate_names_for_people(
+                pco,
+                known_names,
+                name_cache,
+                max_workers=int(os.environ.get("NAME_WORKERS", "1")),
+            )
+            if name_cache is not None:
+                name_cache.save()
+            if snapshot is not None:
+                snapshot.store_names(
+                    connect_group_person_manager.member_names, replace=full_resync
+                )
+                snapshot.commit_sync(full_resync)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+    metrics.record(
+        names_fetched=connect_group_person_manager.names_fetched,
+        name_requests=connect_group_person_manager.name_requests,
+        connect_groups=connect_group_person_manager.connect_groups_count,
+        connect_group_members=connect_group_person_manager.connect_groups_member_count,
+    )
+    from inc_cg_reporter.excel_writer import (
+        ConnectGroupWorksheetGenerator,
+        ConnectGroupWorkbookManager,
+    )
+
     # Now that Names have been populated, we can pass the full list of attributes
     #  to be used as columns, so we know how to generate worksheets for connect groups
     cg_worksheet_generator = ConnectGroupWorksheetGenerator(
@@ -105,18 +433,100 @@ def run() -> None:
         + PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES
     )
     cg_workbook_manager = ConnectGroupWorkbookManager(
-        connect_group_person_manager, cg_worksheet_generator
+        connect_group_person_manager,
+        cg_worksheet_generator,
+        write_only=os.environ.get("WORKBOOK_WRITE_ONLY", "false").lower() == "true",
+        processes=int(os.environ.get("WORKBOOK_PROCESSES", "1")),
+        sheet_cache=get_sheet_cache(),
+        compresslevel=int(os.environ.get("WORKBOOK_COMPRESSION_LEVEL", "6")),
     )
     logger.info("Creating worksheet")
-    cg_workbook_manager.create()
-    saved_file = cg_workbook_manager.save()
-    logger.info("Saved file stored as %s", saved_file.resolve())
-    logger.info("Stat info: %s", os.stat(saved_file))
+    with metrics.phase("workbook_create"):
+        cg_workbook_manager.create()
+    with metrics.phase("workbook_save"):
+        workbook = cg_workbook_manager.spool()
+        workbook.seek(0, os.SEEK_END)
+        workbook_bytes = workbook.tell()
+        workbook.seek(0)
+        if output_file := os.environ.get("OUTPUT_FILE"):
+            with open(output_file, "wb") as out:
+                shutil.copyfileobj(workbook, out)
+            workbook.seek(0)
+            logger.info("Workbook saved as %s", output_file)
+    logger.info("Workbook is %d bytes", workbook_bytes)
+    metrics.record(
+        workbook_bytes=workbook_bytes,
+        sheets_reused=cg_workbook_manager.sheets_reused,
+        sheets_rebuilt=cg_workbook_manager.sheets_rebuilt,
+    )
     if os.environ.get("SEND_EMAIL", "true").lower() == "true":
-        send_summary_email(saved_file)
+        smtp_pool = get_smtp_pool()
+        try:
+            with metrics.phase("email"):
+                delivered = [send_summary_email(workbook, smtp_pool)]
+                if (leader_emails := get_leader_emails()) is not None:
+                    if unled := sorted(
+                        cg.name
+                        for cg in connect_group_person_manager.populated_connect_groups
+                        if cg.name not in leader_emails
+                    ):
+                        logger.info(
+                            "No leader emails for %d connect groups: %s",
+                            len(unled),
+                            ", ".join(unled),
+                        )
+                    delivered.append(
+                        send_leader_emails(
+                            cg_workbook_manager, leader_emails, smtp_pool
+                        )
+                    )
+        finally:
+            smtp_pool.close()
+        metrics.record(
+            emails_sent=sum(stats.sent for stats in delivered),
+            emails_failed=sum(stats.failed for stats in delivered),
+        )
     else:
         logger.info("SEND_EMAIL is not true; skipping email")
+    scheduler = pco.session
+    scheduler.log_stats()
+    metrics.record(
+        pco_requests=scheduler.requests_sent,
+        pco_rate_limited=scheduler.rate_limited,
+        pco_pages=scheduler.pages_received,
+        pco_response_bytes=scheduler.bytes_received,
+    )
+    if http_cache is not None:
+        http_cache.log_stats()
+        metrics.record(
+            http_cache_hits=http_cache.hits,
+            http_cache_misses=http_cache.misses,
+            http_cache_bytes_saved=http_cache.bytes_saved,
+        )
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    daiquiri.setup(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Email the connect group report",
+        epilog="Settings not given here are read from the environment (or .env)",
+    )
+    parser.add_argument(
+        "--profile-dir", help="profile phases, writing results here (PROFILE_DIR)"
+    )
+    parser.add_argument(
+        "--profile-modes",
+        help="comma separated: cprofile, tracemalloc, sample (PROFILE_MODES)",
+    )
+    parser.add_argument(
+        "--profile-phases", help="comma separated; all if unset (PROFILE_PHASES)"
+    )
+    args = parser.parse_args()
+    run(get_profiler(args.profile_dir, args.profile_modes, args.profile_phases))
 
 
 if __name__ == "__main__":
-    run()
+    main()
@@ -0,0 +1,270 @@
+"""Times each stage of a report against fake PCO organisations of growing size
+
+    python -m inc_cg_reporter.benchmark --sizes 1000 5000 20000 \\
+        --output results.json --baseline benchmarks/baseline.json
+
+Each size is served by a FakePCOServer in a child process, so the peak RSS
+recorded is the reporter's own. Results are compared against the baseline
+and the run fails if any stage regressed by more than --threshold. Timings
+and memory only mean something on the machine (and Python) that recorded the
+baseline, so for a baseline from anywhere else only request counts are
+compared.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import pathlib
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from typing import Collection, Dict, Iterator, List, Optional
+
+import daiquiri
+import pypco
+
+from inc_cg_reporter.app import build_summary_email
+from inc_cg_reporter.connect_group import (
+    ConnectGroupMembershipManager,
+    PersonManager,
+)
+from inc_cg_reporter.excel_writer import (
+    ConnectGroupWorkbookManager,
+    ConnectGroupWorksheetGenerator,
+)
+from inc_cg_reporter.fake_pco import FakePCOServer, generate_organisation
+from inc_cg_reporter.field_definition import (
+    FieldDataProcessor,
+    CONNECT_GROUP_FIELD_DEFINITION_NAME,
+    PERSONAL_ATTRIBUTE_NAME,
+    PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES,
+    PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES,
+)
+from inc_cg_reporter.metrics import peak_rss_kb
+from inc_cg_reporter.scheduler import RequestScheduler
+
+logger = daiquiri.getLogger(__name__)
+
+# stage name -> {"wall_seconds", "requests", "peak_rss_kb"}
+StageResults = Dict[str, Dict[str, float]]
+
+DEFAULT_SIZES = [1000, 5000, 20000]
+DEFAULT_THRESHOLD = 0.25
+# Stages quicker than this are too noisy to compare wall times for
+MIN_COMPARABLE_SECONDS = 0.05
+# Measures that don't depend on the machine the benchmark runs on
+PORTABLE_MEASURES = ("requests",)
+
+
+def _serve(people: int, seed: int, latency: float, queue) -> None:
+    organisation = generate_organisation(people, max(1, people // 100), seed=seed)
+    server = FakePCOServer(organisation, latency=latency)
+    queue.put(server.api_base)
+    server.serve_forever()
+
+
+def run_stages(
+    pco: pypco.PCO,
+    scheduler: RequestScheduler,
+    write_only: bool = False,
+    processes: int = 1,
+) -> StageResults:
+    """Produces one report from pco, timing each stage"""
+    results: StageResults = {}
+
+    @contextmanager
+    def stage(name: str) -> Iterator[None]:
+        requests_before = scheduler.requests_sent
+        start = time.perf_counter()
+        yield
+        results[name] = {
+            "wall_seconds": round(time.perf_counter() - start, 4),
+            "requests": scheduler.requests_sent - requests_before,
+            "peak_rss_kb": peak_rss_kb(),
+        }
+
+    person_manager = PersonManager()
+    membership_manager = ConnectGroupMembershipManager(person_manager)
+    processor = FieldDataProcessor(
+        pco,
+        CONNECT_GROUP_FIELD_DEFINITION_NAME,
+        PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES,
+        PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES,
+        person_manager,
+        membership_manager,
+    )
+    with stage("field_definition_mapping"):
+        field_handler = processor.build_field_handler()
+    with stage("field_data_processing"):
+        processor.process_field_data(field_handler)
+    with stage("name_population"):
+        membership_manager.populate_names_for_people(pco)
+    workbook_manager = ConnectGroupWorkbookManager(
+        membership_manager,
+        ConnectGroupWorksheetGenerator(
+            [PERSONAL_ATTRIBUTE_NAME]
+            + PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES
+            + PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES
+        ),
+        write_only,
+        processes,
+    )
+    with stage("workbook_create"):
+        workbook_manager.create()
+    with stage("workbook_save"):
+        workbook = workbook_manager.spool()
+    with stage("email_assembly"):
+        build_summary_email(
+            workbook, "reports@example.com", "leaders@example.com"
+        ).as_bytes()
+    workbook.close()
+    return results
+
+
+def benchmark_size(
+    people: int,
+    seed: int = 0,
+    latency: float = 0.0,
+    repeat: int = 3,
+    write_only: bool = False,
+    processes: int = 1,
+) -> StageResults:
+    """Best of repeat reports against a fake organisation of people
+
+    Wall time is the quickest of the runs, to keep noise out of comparisons;
+    peak RSS is the process's high water mark, so it includes smaller sizes
+    benchmarked before this one.
+    """
+    queue: multiprocessing.Queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=_serve, args=(people, seed, latency, queue), daemon=True
+    )
+    server.start()
+    try:
+        api_base = queue.get(timeout=300)
+        pco = pypco.PCO("benchmark", "benchmark", api_base=api_base)
+        # Count requests, but don't hold the fake server to PCO's rate limit
+        scheduler = RequestScheduler.install(pco, rate_limit=10**9)
+        runs = [
+            run_stages(pco, scheduler, write_only, processes) for _ in range(repeat)
+        ]
+    finally:
+        server.terminate()
+        server.join()
+    results = {
+        name: {
+            "wall_seconds": min(run[name]["wall_seconds"] for run in runs),
+            "requests": runs[-1][name]["requests"],
+            "peak_rss_kb": runs[-1][name]["peak_rss_kb"],
+        }
+        for name in runs[0]
+    }
+    for name, measures in results.items():
+        logger.info("%d people: %s %s", people, name, measures)
+    return results
+
+
+def compare(
+    results: Dict[str, StageResults],
+    baseline: Dict[str, StageResults],
+    threshold: float = DEFAULT_THRESHOLD,
+    measures: Optional[Collection[str]] = None,
+) -> List[str]:
+    """Descriptions of every stage measure (or just those in measures) more
+    than threshold worse than the baseline; sizes or stages missing from the
+    baseline are skipped"""
+    regressions = []
+    for size, stages in results.items():
+        for stage_name, stage_measures in stages.items():
+            base = baseline.get(size, {}).get(stage_name)
+            if base is None:
+                continue
+            for measure, value in stage_measures.items():
+                if measures is not None and measure not in measures:
+                    continue
+                base_value = base.get(measure)
+                if base_value is None or value <= base_value * (1 + threshold):
+                    continue
+                if (
+                    measure == "wall_seconds"
+                    and max(value, base_value) < MIN_COMPARABLE_SECONDS
+                ):
+                    continue
+                regressions.append(
+                    f"{size} people, {stage_name}: {measure} {value}"
+                    f" vs baseline {base_value}"
+                )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    daiquiri.setup(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--write-only", action="store_true")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--baseline", type=pathlib.Path)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="write these results to --baseline instead of comparing",
+    )
+    args = parser.parse_args(argv)
+
+    results = {
+        str(size): benchmark_size(
+            size,
+            args.seed,
+            args.latency,
+            args.repeat,
+            args.write_only,
+            args.processes,
+        )
+        for size in args.sizes
+    }
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+        logger.info("Results written to %s", args.output)
+    if args.baseline is None:
+        return 0
+    if args.update_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(report, indent=2) + "\n")
+        logger.info("Baseline updated at %s", args.baseline)
+        return 0
+    baseline = json.loads(args.baseline.read_text())
+    measures = None
+    recorded_on = (baseline.get("python"), baseline.get("platform"))
+    if recorded_on != (report["python"], report["platform"]):
+        logger.warning(
+            "Baseline was recorded with Python %s on %s, not Python %s on %s;"
+            " only comparing %s",
+            *recorded_on,
+            report["python"],
+            report["platform"],
+            ", ".join(PORTABLE_MEASURES),
+        )
+        measures = PORTABLE_MEASURES
+    regressions = compare(results, baseline["results"], args.threshold, measures)
+    for regression in regressions:
+        logger.error("Regression: %s", regression)
+    if regressions:
+        return 1
+    logger.info("No regressions beyond %.0f%% of the baseline", args.threshold * 100)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
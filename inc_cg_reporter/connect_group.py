@@ -1,27 +1,138 @@
 import logging
+import sys
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Dict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
 
 import daiquiri
 import pypco
+from more_itertools import chunked
 
 from inc_cg_reporter.field_definition import PERSONAL_ATTRIBUTE_NAME
+from inc_cg_reporter.name_cache import PersonNameCache
 
-daiquiri.setup(level=logging.INFO)
 logger = daiquiri.getLogger(__name__)
 
 
-@dataclass
+class AttributeSchema:
+    """Assigns each attribute name a fixed position, shared by many people
+
+    Storing values positionally means a person doesn't need their own dict
+    keyed by the same handful of field names as everyone else.
+    """
+
+    def __init__(self):
+        self._positions: Dict[str, int] = {}
+
+    def position(self, name: str) -> int:
+        """Position of an attribute, adding it to the schema if it's new"""
+        if (pos := self._positions.get(name)) is None:
+            pos = self._positions[name] = len(self._positions)
+        return pos
+
+    def lookup(self, name: str) -> Optional[int]:
+        return self._positions.get(name)
+
+    def items(self) -> Iterable[Tuple[str, int]]:
+        return self._positions.items()
+
+
+# Marks positions a person has no value for (None is a legitimate value)
+_UNSET: Any = object()
+DEFAULT_ATTRIBUTE_SCHEMA = AttributeSchema()
+
+
+@dataclass(slots=True, eq=False)
 class Person:
     id: int
-    personal_attributes: Dict[str, str] = field(default_factory=dict)
+    schema: AttributeSchema = field(default=DEFAULT_ATTRIBUTE_SCHEMA, repr=False)
+    _values: List[Any] = field(default_factory=list, repr=False)
+
+    def get_attribute(self, name: str, default: Any = None) -> Any:
+        pos = self.schema.lookup(name)
+        if pos is None or pos >= len(self._values):
+            return default
+        value = self._values[pos]
+        return default if value is _UNSET else value
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        pos = self.schema.position(name)
+        if pos >= len(self._values):
+            self._values.extend([_UNSET] * (pos + 1 - len(self._values)))
+        self._values[pos] = value
+
+    @property
+    def personal_attributes(self) -> "PersonalAttributes":
+        return PersonalAttributes(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Person):
+            return NotImplemented
+        return self.id == other.id and dict(self.personal_attributes) == dict(
+            other.personal_attributes
+        )
+
+    def __repr__(self):
+        return f"Person(id={self.id!r}, {dict(self.personal_attributes)!r})"
+
+
+class PersonalAttributes(MutableMapping[str, Any]):
+    """Dict-like view of a Person's attributes, keyed by attribute name"""
+
+    __slots__ = ("_person",)
+
+    def __init__(self, person: Person):
+        self._person = person
+
+    def __getitem__(self, name: str) -> Any:
+        value = self._person.get_attribute(name, _UNSET)
+        if value is _UNSET:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        self._person.set_attribute(name, value)
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self:
+            raise KeyError(name)
+        self._person.set_attribute(name, _UNSET)
+
+    def __iter__(self) -> Iterator[str]:
+        values = self._person._values
+        for name, pos in self._person.schema.items():
+            if pos < len(values) and values[pos] is not _UNSET:
+                yield name
+
+    def __len__(self) -> int:
+        return sum(1 for value in self._person._values if value is not _UNSET)
 
 
 @dataclass
 class ConnectGroup:
     name: str
-    members: List[Person] = field(default_factory=list)
+    # Keyed by person id, so members stay in the order they were added but
+    #  adding, checking for and removing a member are all O(1)
+    member_by_id: Dict[int, Person] = field(default_factory=dict)
+
+    @property
+    def members(self) -> List[Person]:
+        return list(self.member_by_id.values())
+
+
+# Called with (person, field name, values added)
+ValuesAddedListener = Callable[[Person, str, List[Any]], None]
 
 
 class PersonManager:
@@ -30,11 +141,21 @@ class PersonManager:
 
     def __init__(self):
         self._people: Dict[int, Person] = {}
+        self._schema = AttributeSchema()
+        self._values_added_listeners: List[ValuesAddedListener] = []
+
+    def add_values_added_listener(self, listener: ValuesAddedListener):
+        """Calls listener(person, field_name, values) as multi-value attributes grow"""
+        self._values_added_listeners.append(listener)
+
+    def _values_added(self, person: Person, field_name: str, values: List[Any]):
+        for listener in self._values_added_listeners:
+            listener(person, field_name, values)
 
     def get(self, person_id: int):
         person = self._people.get(person_id)
         if not person:
-            person = Person(person_id)
+            person = Person(person_id, self._schema)
             self._people[person_id] = person
 
         return person
@@ -52,125 +173,304 @@ class PersonManager:
             person_id,
         )
         person = self.get(person_id)
-        person.personal_attributes[field_name] = field_value
+        person.set_attribute(field_name, field_value)
 
     def add_or_extend_attribute(
         self, field_name: str, field_value: str, person_id: int
     ):
-        # Add attribute, preserving existing values if present
+        # Add attribute, preserving existing values if present. Multi-value
+        #  attributes are kept as a list and only joined up when rendered.
         person = self.get(person_id)
-        if current_field_value := person.personal_attributes.get(field_name):
+        if (current_field_values := person.get_attribute(field_name)) is not None:
             logger.debug(
-                "Extending attribute %s (existing value %s) with value %s to person with id %s",
+                "Extending attribute %s (existing values %s) with value %s to person with id %s",
                 field_name,
-                current_field_value,
+                current_field_values,
                 field_value,
                 person_id,
             )
-            person.personal_attributes[field_name] = (
-                current_field_value + self.ADD_EXTEND_SEPARATOR + field_value
-            )
+            current_field_values.append(self._intern(field_value))
         else:
-            self.add_attribute(field_name, field_value, person_id)
+            logger.debug(
+                "Adding attribute %s with value %s to person with id %s",
+                field_name,
+                field_value,
+                person_id,
+            )
+            person.set_attribute(field_name, [self._intern(field_value)])
+        self._values_added(person, field_name, [field_value])
+
+    @staticmethod
+    def _intern(field_value: str) -> str:
+        # Multi-value fields draw on a small set of values (team names), so
+        #  share one copy of each rather than one per person
+        return sys.intern(field_value) if isinstance(field_value, str) else field_value
+
+    def add_attributes_bulk(self, field_name: str, records: Iterable[Tuple[int, str]]):
+        """add_attribute for many (person_id, value) pairs of the same field"""
+        if logger.isEnabledFor(logging.DEBUG):
+            for person_id, field_value in records:
+                self.add_attribute(field_name, field_value, person_id)
+            return
+        for person_id, field_value in records:
+            self.get(person_id).set_attribute(field_name, field_value)
+
+    def add_or_extend_attributes_bulk(
+        self, field_name: str, records: Iterable[Tuple[int, str]]
+    ):
+        """add_or_extend_attribute for many (person_id, value) pairs"""
+        if logger.isEnabledFor(logging.DEBUG):
+            for person_id, field_value in records:
+                self.add_or_extend_attribute(field_name, field_value, person_id)
+            return
+        for person_id, field_value in records:
+            person = self.get(person_id)
+            if (current_field_values := person.get_attribute(field_name)) is not None:
+                current_field_values.append(self._intern(field_value))
+            else:
+                person.set_attribute(field_name, [self._intern(field_value)])
+            self._values_added(person, field_name, [field_value])
 
 
 class ConnectGroupMembershipManager:
+
+    VOLUNTEER_FIELD_NAME = "Team"
+
     def __init__(self, pm: PersonManager):
         self.connect_groups: Dict[str, ConnectGroup] = {}
         self._person_manager = pm
-
-    def add(self, _: str, connect_group_name: str, person_id: int):
-        logger.debug(
-            "Adding person %s to Connect Group %s", person_id, connect_group_name
-        )
+        # Summary statistics are kept up to date as members come and go and as
+        #  people join teams, so reading them doesn't need a scan of every
+        #  group (see verify_statistics).
+        self._member_count = 0
+        self._populated_count = 0
+        self._populated_connect_groups: Optional[List[ConnectGroup]] = None
+        self._volunteer_count: Counter = Counter()
+        # Person id to the groups they're in (a dict, used as an ordered set)
+        self._groups_by_person: Dict[int, Dict[str, ConnectGroup]] = {}
+        pm.add_values_added_listener(self._person_values_added)
+        # Set by populate_names_for_people
+        self.names_fetched = 0
+        self.name_requests = 0
+
+    def _add_member(self, connect_group_name: str, person_id: int):
         cg = self.connect_groups.get(connect_group_name)
         if not cg:
             cg = ConnectGroup(connect_group_name)
             self.connect_groups[connect_group_name] = cg
 
+        if person_id in cg.member_by_id:
+            # PCO can return the same membership datum more than once
+            return
         person = self._person_manager.get(person_id)
-        cg.members.append(person)
+        cg.member_by_id[person_id] = person
+        if len(cg.member_by_id) == 1:
+            self._populated_count += 1
+            self._populated_connect_groups = None
+        self._member_count += 1
+        self._groups_by_person.setdefault(person_id, {})[connect_group_name] = cg
+        self._volunteer_count.update(
+            person.get_attribute(self.VOLUNTEER_FIELD_NAME, ())
+        )
+
+    def _person_values_added(self, person: Person, field_name: str, values: List[Any]):
+        # Volunteers are counted once per connect group membership
+        if field_name == self.VOLUNTEER_FIELD_NAME and (
+            groups := self._groups_by_person.get(person.id)
+        ):
+            for value in values:
+                self._volunteer_count[value] += len(groups)
+
+    def groups_for_person(self, person_id: int) -> List[ConnectGroup]:
+        """Connect groups a person belongs to, in the order they joined them"""
+        return list(self._groups_by_person.get(person_id, {}).values())
+
+    def add(self, _: str, connect_group_name: str, person_id: int):
+        logger.debug(
+            "Adding person %s to Connect Group %s", person_id, connect_group_name
+        )
+        self._add_member(connect_group_name, person_id)
+
+    def add_members_bulk(self, _: str, records: Iterable[Tuple[int, str]]):
+        """add for many (person_id, connect group name) pairs"""
+        if logger.isEnabledFor(logging.DEBUG):
+            for person_id, connect_group_name in records:
+                self.add(_, connect_group_name, person_id)
+            return
+        for person_id, connect_group_name in records:
+            self._add_member(connect_group_name, person_id)
 
     @staticmethod
-    def get_person_name_from_id(pco: pypco.PCO, person_id: int) -> str:
+    def get_person_name_from_id(
+        pco: pypco.PCO, person_id: int, name_cache: Optional[PersonNameCache] = None
+    ) -> str:
+        if name_cache is not None and (name := name_cache.get(person_id)) is not None:
+            return name
         params = {"where[id]": person_id}
         person = pco.get("/people/v2/people", **params)
         if len(person["data"]) > 0:
-            return str(person["data"][0]["attributes"]["name"])
+            attributes = person["data"][0]["attributes"]
+            name = str(attributes["name"])
+            if name_cache is not None:
+                name_cache.put(person_id, name, attributes.get("updated_at"))
+            return name
+        if name_cache is not None:
+            name_cache.invalidate(person_id)
         return f"Name Missing (id: {person_id})"
 
-    def populate_names_for_people(self, pco: pypco.PCO):
-        unique_person_ids = list({
-            person.id
-            for cg in self.connect_groups.values()
-            for person in cg.members
-        })
+    @staticmethod
+    def iterate_people_updated_since(
+        pco: pypco.PCO, since: str
+    ) -> Iterator[Tuple[int, str, Optional[str]]]:
+        """(id, name, updated_at) of everyone in PCO whose record has changed
+        since a sync time"""
+        params = {"where[updated_at][gte]": since, "order": "updated_at"}
+        for person in pco.iterate("/people/v2/people", per_page=100, **params):
+            attributes = person["data"]["attributes"]
+            yield (
+                int(person["data"]["id"]),
+                str(attributes["name"]),
+                attributes.get("updated_at"),
+            )
+
+    @classmethod
+    def get_names_updated_since(cls, pco: pypco.PCO, since: str) -> Dict[int, str]:
+        """Names of everyone in PCO whose record has changed since a sync time"""
+        return {
+            person_id: name
+            for person_id, name, _ in cls.iterate_people_updated_since(pco, since)
+        }
+
+    def populate_names_for_people(
+        self,
+        pco: pypco.PCO,
+        known_names: Optional[Dict[int, str]] = None,
+        name_cache: Optional[PersonNameCache] = None,
+        max_workers: int = 1,
+    ):
+        """Sets names on all members, only asking PCO for ones we don't know
+
+        Names come from known_names, then name_cache, then PCO (in batches
+        of 100 ids, up to max_workers batches at a time). Only people fetched
+        from PCO can be detected as deleted, so known_names should come from
+        a recent, trusted source (see FieldDataSnapshot). name_cache is first
+        refreshed with people updated since its previous run, but a deleted
+        person with a cached name stays until their entry expires (see
+        PersonNameCache).
+        """
+        if name_cache is not None and (since := name_cache.refreshed_at):
+            renamed = name_cache.refresh(self.iterate_people_updated_since(pco, since))
+            logger.info("%d cached names changed in PCO since %s", renamed, since)
+        known_names = known_names or {}
+        unique_person_ids = []
+        known_count = 0
+        cached_count = 0
+        for person_id in self._groups_by_person:
+            if (name := known_names.get(person_id)) is not None:
+                known_count += 1
+            elif (
+                name_cache is not None
+                and (name := name_cache.get(person_id)) is not None
+            ):
+                cached_count += 1
+            else:
+                unique_person_ids.append(person_id)
+                continue
+            self._person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, name, person_id)
         logger.info(
-            "Fetching names for %d unique people across %d connect groups",
+            "Fetching names for %d unique people across %d connect groups"
+            " (%d already known, %d cached)",
             len(unique_person_ids),
             len(self.connect_groups),
+            known_count,
+            cached_count,
         )
 
         batch_size = 100
-        num_batches = -(-len(unique_person_ids) // batch_size)
+        batches = list(chunked(unique_person_ids, batch_size))
+        num_batches = len(batches)
         total_fetched = 0
         missing_ids: set[int] = set()
 
-        for batch_num, i in enumerate(
-            range(0, len(unique_person_ids), batch_size), start=1
-        ):
-            batch = unique_person_ids[i : i + batch_size]
-            response = pco.get(
+        def fetch_batch(batch: List[int]) -> dict:
+            response: dict = pco.get(
                 "/people/v2/people",
                 per_page=batch_size,
                 **{"where[id]": ",".join(str(pid) for pid in batch)},
             )
-            returned_ids = set()
-            for person_data in response["data"]:
-                person_id = int(person_data["id"])
-                self._person_manager.add_attribute(
-                    PERSONAL_ATTRIBUTE_NAME,
-                    str(person_data["attributes"]["name"]),
-                    person_id,
-                )
-                returned_ids.add(person_id)
-
-            for pid in batch:
-                if pid not in returned_ids:
-                    # PCO returns no record for this id (the person has been
-                    #  deleted), yet a stale "Connect Group" field datum still
-                    #  lists them as a member. Drop them rather than emitting a
-                    #  "Name Missing" row in the report.
-                    logger.warning(
-                        "No PCO record for person id %s (deleted person with "
-                        "orphaned field data); removing from connect groups",
-                        pid,
+            return response
+
+        workers = max(1, min(max_workers, num_batches))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Responses are handled on this thread, in batch order
+            for batch_num, (batch, response) in enumerate(
+                zip(batches, executor.map(fetch_batch, batches)), start=1
+            ):
+                returned_ids = set()
+                for person_data in response["data"]:
+                    person_id = int(person_data["id"])
+                    attributes = person_data["attributes"]
+                    name = str(attributes["name"])
+                    self._person_manager.add_attribute(
+                        PERSONAL_ATTRIBUTE_NAME, name, person_id
                     )
-                    missing_ids.add(pid)
-
-            total_fetched += len(returned_ids)
-            logger.info(
-                "  Batch %d/%d: %d names fetched", batch_num, num_batches, len(returned_ids)
-            )
+                    if name_cache is not None:
+                        name_cache.put(person_id, name, attributes.get("updated_at"))
+                    returned_ids.add(person_id)
+
+                for pid in batch:
+                    if pid not in returned_ids:
+                        # PCO returns no record for this id (the person has been
+                        #  deleted), yet a stale "Connect Group" field datum still
+                        #  lists them as a member. Drop them rather than emitting a
+                        #  "Name Missing" row in the report.
+                        logger.warning(
+                            "No PCO record for person id %s (deleted person with "
+                            "orphaned field data); removing from connect groups",
+                            pid,
+                        )
+                        missing_ids.add(pid)
+                        if name_cache is not None:
+                            name_cache.invalidate(pid)
+
+                total_fetched += len(returned_ids)
+                logger.info(
+                    "  Batch %d/%d: %d names fetched",
+                    batch_num,
+                    num_batches,
+                    len(returned_ids),
+                )
 
         if missing_ids:
             self._remove_people_from_connect_groups(missing_ids)
+        if logger.isEnabledFor(logging.DEBUG):
+            self.verify_statistics()
 
+        self.names_fetched = total_fetched
+        self.name_requests = num_batches
         logger.info(
-            "Finished fetching names: %d total in %d batched requests"
-            " (previously %d sequential requests)",
+            "Finished fetching names: %d total in %d batched requests",
             total_fetched,
             num_batches,
-            len(unique_person_ids),
         )
 
     def _remove_people_from_connect_groups(self, person_ids: set[int]) -> None:
         """Drop members whose ids PCO could not resolve from every connect group."""
         removed = 0
-        for cg in self.connect_groups.values():
-            before = len(cg.members)
-            cg.members = [m for m in cg.members if m.id not in person_ids]
-            removed += before - len(cg.members)
+        for person_id in person_ids:
+            groups = self._groups_by_person.pop(person_id, {})
+            for cg in groups.values():
+                person = cg.member_by_id.pop(person_id)
+                self._volunteer_count.subtract(
+                    person.get_attribute(self.VOLUNTEER_FIELD_NAME, ())
+                )
+                if not cg.member_by_id:
+                    self._populated_count -= 1
+                    self._populated_connect_groups = None
+            removed += len(groups)
+        self._member_count -= removed
+        # Drop teams whose count has fallen to zero
+        self._volunteer_count = +self._volunteer_count
         logger.warning(
             "Removed %d unresolved member(s) across %d id(s): %s",
             removed,
@@ -178,6 +478,17 @@ class ConnectGroupMembershipManager:
             sorted(person_ids),
         )
 
+    @property
+    def member_names(self) -> Dict[int, str]:
+        names = {}
+        for person_id in self._groups_by_person:
+            name = self._person_manager.get(person_id).get_attribute(
+                PERSONAL_ATTRIBUTE_NAME
+            )
+            if name is not None:
+                names[person_id] = name
+        return names
+
     @property
     def populated_connect_groups(self) -> List[ConnectGroup]:
         """Connect groups that still have at least one member.
@@ -186,22 +497,65 @@ class ConnectGroupMembershipManager:
         _remove_people_from_connect_groups); such groups exist only because of
         orphaned field data and are excluded from the report.
         """
-        return [cg for cg in self.connect_groups.values() if cg.members]
+        if self._populated_connect_groups is None:
+            self._populated_connect_groups = [
+                cg for cg in self.connect_groups.values() if cg.member_by_id
+            ]
+        return self._populated_connect_groups
 
     @property
     def connect_groups_count(self):
-        return len(self.populated_connect_groups)
+        return self._populated_count
 
     @property
     def connect_groups_member_count(self):
-        return sum([len(cg.members) for cg in self.connect_groups.values()])
+        return self._member_count
 
     @property
-    def volunteer_count(self):
-        vc = Counter()
+    def volunteer_count(self) -> Counter:
+        """Members of each team, with teams in the order a scan of the groups
+        and their members first comes across them (as the About sheet lists
+        them), rather than the order field data arrived in
+
+        The counts are maintained; only the order needs a scan, and it stops
+        once every team has been seen.
+        """
+        remaining = set(self._volunteer_count)
+        ordered: Counter = Counter()
+        for cg in self.connect_groups.values():
+            for member in cg.member_by_id.values():
+                for team in member.get_attribute(self.VOLUNTEER_FIELD_NAME, ()):
+                    if team in remaining:
+                        remaining.remove(team)
+                        ordered[team] = self._volunteer_count[team]
+                if not remaining:
+                    return ordered
+        return ordered
+
+    def _recompute_statistics(self) -> Tuple[int, int, Counter]:
+        vc: Counter = Counter()
         for cg in self.connect_groups.values():
             for member in cg.members:
-                team_str = member.personal_attributes.get("Team", "")
-                if team_str:
-                    vc.update(team_str.split(","))
-        return vc
+                vc.update(member.get_attribute(self.VOLUNTEER_FIELD_NAME, ()))
+        return (
+            len([cg for cg in self.connect_groups.values() if cg.member_by_id]),
+            sum([len(cg.member_by_id) for cg in self.connect_groups.values()]),
+            vc,
+        )
+
+    def verify_statistics(self) -> None:
+        """Checks the maintained statistics against a full recompute"""
+        maintained = (self._populated_count, self._member_count, self.volunteer_count)
+        recomputed = self._recompute_statistics()
+        # Counter equality ignores order, which the About sheet doesn't
+        if maintained != recomputed or list(maintained[2].items()) != list(
+            recomputed[2].items()
+        ):
+            logger.critical(
+                "Connect group statistics are inconsistent: maintained %s, "
+                "recomputed %s",
+                maintained,
+                recomputed,
+            )
+            raise RuntimeError("Connect group statistics are inconsistent")
+        logger.debug("Connect group statistics verified: %s", maintained)
@@ -0,0 +1,161 @@
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from email.message import Message
+from typing import Iterable, Iterator, Optional
+
+import daiquiri
+
+logger = daiquiri.getLogger(__name__)
+
+
+class SMTPPool:
+    """Up to size SMTP connections, each set up (STARTTLS, login) once and
+    reused for as many messages as it lasts"""
+
+    DEFAULT_SIZE = 4
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        size: int = DEFAULT_SIZE,
+        starttls: bool = True,
+        timeout: float = 60,
+    ):
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._starttls = starttls
+        self._timeout = timeout
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: "queue.LifoQueue[smtplib.SMTP]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        connection = smtplib.SMTP(self._host, self._port, timeout=self._timeout)
+        try:
+            if self._starttls:
+                connection.starttls()
+            if self._username:
+                connection.login(self._username, self._password or "")
+        except BaseException:
+            connection.close()
+            raise
+        with self._lock:
+            self.connections_opened += 1
+        return connection
+
+    @contextmanager
+    def connection(self) -> Iterator[smtplib.SMTP]:
+        """A connection to use on its own; waits for one if size are in use
+
+        A connection that raised an error is closed rather than reused, as
+        it may be part way through a message or already disconnected.
+        """
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self._idle.put(connection)
+
+    def close(self) -> None:
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+
+
+@dataclass
+class DeliveryStats:
+    sent: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.sent / self.seconds if self.seconds else 0.0
+
+
+def _permanent(error: Exception) -> bool:
+    """Whether the server has refused something that won't succeed if retried"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def deliver(
+    pool: SMTPPool,
+    messages: Iterable[Message],
+    max_attempts: int = 3,
+    retry_delay: float = 1.0,
+) -> DeliveryStats:
+    """Sends messages over pool's connections, as many at once as it has
+
+    Messages are sent as they're produced, so messages can be a generator
+    that's still rendering later ones. A message that fails with a temporary
+    error is retried on another connection, after retry_delay seconds
+    (doubling with each attempt); failures are logged and counted, not
+    raised.
+    """
+    stats = DeliveryStats()
+    lock = threading.Lock()
+
+    def send(message: Message) -> None:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                with pool.connection() as connection:
+                    connection.send_message(message)
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                logger.warning(
+                    "Sending %r to %s failed (attempt %d of %d): %s",
+                    message["Subject"],
+                    message["To"],
+                    attempt,
+                    max_attempts,
+                    e,
+                )
+                if _permanent(e) or attempt == max_attempts:
+                    with lock:
+                        stats.failed += 1
+                    return
+                time.sleep(retry_delay * 2 ** (attempt - 1))
+        with lock:
+            stats.sent += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        # Consume the results, so any unexpected error is raised here
+        list(executor.map(send, messages))
+    stats.seconds = time.perf_counter() - start
+    logger.info(
+        "Sent %d messages (%d failed) in %.1fs, %.1f messages/s over %d"
+        " SMTP connections",
+        stats.sent,
+        stats.failed,
+        stats.seconds,
+        stats.messages_per_second,
+        pool.connections_opened,
+    )
+    return stats
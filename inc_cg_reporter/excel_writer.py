@@ -1,22 +1,140 @@
 import datetime
+import hashlib
+import io
+import json
 import pathlib
-from tempfile import NamedTemporaryFile
-from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from typing import (
+    IO,
+    Callable,
+    Collection,
+    Generator,
+    Iterator,
+    List,
+    Dict,
+    Optional,
+    Tuple,
+    Union,
+)
+from weakref import WeakKeyDictionary
+from zipfile import ZIP_DEFLATED, ZipFile
 
 from zoneinfo import ZoneInfo
+import daiquiri
+import openpyxl
 from more_itertools import first
 from openpyxl import Workbook
+from openpyxl.cell import Cell, MergedCell, WriteOnlyCell
 from openpyxl.styles import Alignment, Border, Side
+from openpyxl.styles.cell_style import StyleArray
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.page import PrintPageSetup
+from openpyxl.worksheet._write_only import WriteOnlyWorksheet
+from openpyxl.writer.excel import ExcelWriter
 from openpyxl.worksheet.worksheet import Worksheet
 
 from inc_cg_reporter.connect_group import (
     ConnectGroup,
     ConnectGroupMembershipManager,
     Person,
+    PersonManager,
 )
 from inc_cg_reporter.field_definition import PERSONAL_ATTRIBUTE_NAME
+from inc_cg_reporter.openpyxl_compat import (
+    PrewrittenSheet,
+    add_sheet,
+    cell_style,
+    register_cell_style,
+    set_cell_style,
+    take_sheet_xml,
+)
+from inc_cg_reporter.sheet_cache import SheetCache
+
+logger = daiquiri.getLogger(__name__)
+
+
+def write_workbook(
+    workbook: Workbook, out: IO[bytes], compresslevel: Optional[int] = None
+) -> None:
+    """Writes workbook to out as an xlsx file
+
+    This is what Workbook.save() does, but it can write to any seekable file
+    object, at any zlib compression level: 0 (none) to 9 (smallest), or
+    None for zlib's default of 6.
+    """
+    archive = ZipFile(
+        out, "w", ZIP_DEFLATED, allowZip64=True, compresslevel=compresslevel
+    )
+    workbook.properties.modified = datetime.datetime.now(
+        tz=datetime.timezone.utc
+    ).replace(tzinfo=None)
+    ExcelWriter(workbook, archive).save()
+
+
+class ConnectGroupStyles:
+    """The cell styles used on connect group sheets, resolved once per workbook
+
+    Giving a cell a named style, alignment or border looks each of them up in
+    the workbook's style tables. Each combination used on a sheet is looked
+    up once here instead, and cells share the resulting style indexes (which
+    relies on openpyxl internals, see openpyxl_compat).
+    """
+
+    THIN_BORDER = Border(
+        left=Side(border_style="thin"),
+        right=Side(border_style="thin"),
+        top=Side(border_style="thin"),
+        bottom=Side(border_style="thin"),
+    )
+    HEADING_BORDER = Border(
+        left=Side(border_style=None),
+        right=Side(border_style=None),
+        top=Side(border_style=None),
+        outline=False,
+    )
+    HEADING_ALIGNMENT = Alignment(horizontal="center", vertical="center")
+    HEADER_ALIGNMENT = Alignment(wrap_text=True, horizontal="center")
+    DATA_ALIGNMENT = Alignment(horizontal="center")
+
+    def __init__(self, ws: Union[Worksheet, WriteOnlyWorksheet]):
+        # Resolving against any of the workbook's sheets registers the named
+        #  styles with the workbook, in the order style() used to apply them
+        self.first_column = self._resolve(ws, "40 % - Accent1")
+        self.header = self._resolve(ws, "Accent1", alignment=self.HEADER_ALIGNMENT)
+        self.data = self._resolve(
+            ws, alignment=self.DATA_ALIGNMENT, border=self.THIN_BORDER
+        )
+        self.heading = self._resolve(
+            ws,
+            "Headline 1",
+            alignment=self.HEADING_ALIGNMENT,
+            border=self.HEADING_BORDER,
+        )
+        # Cells only get style ids as they're saved. Fixing them here, in the
+        #  order a sheet's cells are written, means sheets rendered in another
+        #  workbook (see ConnectGroupWorksheetGenerator.render()) agree on them
+        for style in (self.heading, self.header, self.first_column, self.data):
+            register_cell_style(ws.parent, style)
+
+    @staticmethod
+    def _resolve(
+        ws: Union[Worksheet, WriteOnlyWorksheet],
+        named_style: Optional[str] = None,
+        **attrs,
+    ) -> StyleArray:
+        cell = WriteOnlyCell(ws)
+        if named_style is not None:
+            cell.style = named_style
+        # Named styles reset alignment and border, so these come afterwards
+        for name, attr in attrs.items():
+            setattr(cell, name, attr)
+        return cell_style(cell)
+
+    @staticmethod
+    def apply(cell: Union[Cell, MergedCell], style: StyleArray) -> None:
+        set_cell_style(cell, style)
 
 
 class ConnectGroupWorksheetGenerator:
@@ -27,12 +145,9 @@ class ConnectGroupWorksheetGenerator:
     TEAM_COLUMN_WIDTH = 26
     FIRST_ROW_HEIGHT = 2
     HEADER_ROW_HEIGHT = 30
-    THIN_BORDER = Border(
-        left=Side(border_style="thin"),
-        right=Side(border_style="thin"),
-        top=Side(border_style="thin"),
-        bottom=Side(border_style="thin"),
-    )
+    # Bump when a sheet's layout or styling changes, so cached sheets that
+    #  were rendered the old way aren't reused (see content_hash())
+    SHEET_FORMAT_VERSION = 1
 
     def __init__(self, field_list: List[str]):
         # column indexes start from 1 and enumerate uses zero-based counting,
@@ -40,23 +155,59 @@ class ConnectGroupWorksheetGenerator:
         self._column_locations = {
             col_name: col_number + 1 for col_number, col_name in (enumerate(field_list))
         }
+        self._styles: "WeakKeyDictionary[Workbook, ConnectGroupStyles]" = (
+            WeakKeyDictionary()
+        )
+
+    def styles_for(
+        self, ws: Union[Worksheet, WriteOnlyWorksheet]
+    ) -> ConnectGroupStyles:
+        if (styles := self._styles.get(ws.parent)) is None:
+            styles = self._styles[ws.parent] = ConnectGroupStyles(ws)
+        return styles
+
+    @property
+    def field_list(self) -> List[str]:
+        return list(self._column_locations)
 
     def person_as_row_values(self, person: Person) -> Dict[int, str]:
         row = {}
         # XXX this generator shouldn't need to know where to find the personal
         #  attributes on the person.
         for column_name, value in person.personal_attributes.items():
+            if isinstance(value, list):
+                # Multi-value attribute (see PersonManager.add_or_extend_attribute)
+                value = PersonManager.ADD_EXTEND_SEPARATOR.join(value)
             row[self._column_locations[column_name]] = value
 
         return row
 
+    @staticmethod
+    def _sorted_members(cg: ConnectGroup) -> List[Person]:
+        return sorted(
+            cg.members, key=lambda p: p.personal_attributes[PERSONAL_ATTRIBUTE_NAME]
+        )
+
+    def member_rows(self, cg: ConnectGroup) -> List[Dict[int, str]]:
+        """Row values for cg's members, in the order they appear on its sheet"""
+        return [self.person_as_row_values(p) for p in self._sorted_members(cg)]
+
+    def content_hash(self, cg: ConnectGroup) -> str:
+        """Changes whenever anything on cg's sheet would"""
+        content = [
+            self.SHEET_FORMAT_VERSION,
+            openpyxl.__version__,
+            self.field_list,
+            cg.name,
+            [[p.id, self.person_as_row_values(p)] for p in self._sorted_members(cg)],
+        ]
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
     def populate(self, ws: Worksheet, cg: ConnectGroup):
         ws.title = cg.name
         self.create_column_headers(ws)
-        for person in sorted(
-            cg.members, key=lambda p: p.personal_attributes[PERSONAL_ATTRIBUTE_NAME]
-        ):
-            ws.append(self.person_as_row_values(person))
+        for row in self.member_rows(cg):
+            ws.append(row)
 
     def create_column_headers(self, ws: Worksheet):
         ws.cell(row=1, column=1, value="Name")
@@ -70,15 +221,9 @@ class ConnectGroupWorksheetGenerator:
         ws["A1"] = ws.title
         ws.merge_cells("A1:{}1".format(get_column_letter(ws.max_column)))
         # Style merged cells using the top left cell reference
-        ws["A1"].style = "Headline 1"
-        # alignment is overwritten by style, so set it afterwards
-        ws["A1"].alignment = Alignment(horizontal="center", vertical="center")
-        no_border = Side(border_style=None)
-        ws["A1"].border = Border(
-            left=no_border, right=no_border, top=no_border, outline=False
-        )
+        ConnectGroupStyles.apply(ws["A1"], self.styles_for(ws).heading)
 
-    def style(self, ws: Worksheet):
+    def set_column_widths(self, ws: Union[Worksheet, WriteOnlyWorksheet]):
         # Give columns a fixed width so each sheet can print onto a single
         #  A4 in landscape mode.
         for col_name, col_index in self._column_locations.items():
@@ -93,15 +238,18 @@ class ConnectGroupWorksheetGenerator:
         # Then override the first column width (it's like a header)
 
         ws.column_dimensions["A"].width = self.FIRST_COLUMN_WIDTH
+
+    def style(self, ws: Worksheet):
+        styles = self.styles_for(ws)
+        self.set_column_widths(ws)
         # Style the first column in a header-like way
         for cell in first(ws.columns):
-            cell.style = "40 % - Accent1"
+            ConnectGroupStyles.apply(cell, styles.first_column)
 
         # Style header row (note the overlap with the name column... we're
         #  intentionally overwriting the style of A1 to be what is below)
         for cell in first(ws.rows):
-            cell.style = "Accent1"
-            cell.alignment = Alignment(wrap_text=True, horizontal="center")
+            ConnectGroupStyles.apply(cell, styles.header)
 
         # Intended to be double height, with text wrap set in the loop below
         ws.row_dimensions[1].height = self.HEADER_ROW_HEIGHT
@@ -109,28 +257,133 @@ class ConnectGroupWorksheetGenerator:
         # Style the data cells (non-header cells)
         for row in ws.iter_rows(min_row=2, min_col=2):
             for cell in row:
-                cell.alignment = Alignment(horizontal="center")
-                cell.border = self.THIN_BORDER
+                ConnectGroupStyles.apply(cell, styles.data)
 
     def setup_print_page_setup(self, ws):
         # fitToWidth isn't recognised on numbers. Hardcoding a scale is ghastly,
         #  but it works and will update if it's inappropriate
         ws.page_setup = PrintPageSetup(orientation="landscape", scale=75)
 
+    @staticmethod
+    def _styled_cell(ws: WriteOnlyWorksheet, value, style: StyleArray):
+        cell = WriteOnlyCell(ws, value)
+        ConnectGroupStyles.apply(cell, style)
+        return cell
+
+    def stream(self, ws: WriteOnlyWorksheet, cg: ConnectGroup):
+        """Writes the same sheet as populate(), style(), insert_heading() and
+        setup_print_page_setup(), but row by row into a write-only sheet
+
+        Every cell is written once, already styled, so nothing is held in
+        memory or revisited. Sheet-level settings have to come first.
+        """
+        self.stream_rows(ws, self.member_rows(cg))
+
+    def render(self, title: str, rows: List[Dict[int, str]]) -> bytes:
+        """The XML of a sheet streamed from rows (see member_rows()) into a
+        workbook of its own
+
+        Its cells refer to ConnectGroupStyles by style id, so it can only be
+        added to a write-only workbook that resolved those styles before any
+        others (see ConnectGroupWorkbookManager).
+        """
+        ws = Workbook(write_only=True).create_sheet(title)
+        self.stream_rows(ws, rows)
+        ws.close()
+        return take_sheet_xml(ws)
+
+    def render_workbook(
+        self,
+        title: str,
+        rows: List[Dict[int, str]],
+        compresslevel: Optional[int] = None,
+    ) -> bytes:
+        """An xlsx file of just the sheet streamed from rows"""
+        workbook = Workbook(write_only=True)
+        self.stream_rows(workbook.create_sheet(title), rows)
+        out = io.BytesIO()
+        write_workbook(workbook, out, compresslevel)
+        return out.getvalue()
+
+    def stream_rows(self, ws: WriteOnlyWorksheet, rows: List[Dict[int, str]]):
+        column_count = len(self._column_locations)
+        self.set_column_widths(ws)
+        # insert_heading() leaves the header row's height on the heading row
+        ws.row_dimensions[1].height = self.HEADER_ROW_HEIGHT
+        ws.merged_cells.add("A1:{}1".format(get_column_letter(column_count)))
+        self.setup_print_page_setup(ws)
+
+        styles = self.styles_for(ws)
+        ws.append([self._styled_cell(ws, ws.title, styles.heading)])
+        headers = {1: "Name"}
+        headers.update(
+            (col_index, col_name)
+            for col_name, col_index in self._column_locations.items()
+        )
+        ws.append(
+            [
+                self._styled_cell(ws, headers.get(col_index), styles.header)
+                for col_index in range(1, column_count + 1)
+            ]
+        )
+        for values in rows:
+            ws.append(
+                [self._styled_cell(ws, values.get(1), styles.first_column)]
+                + [
+                    self._styled_cell(ws, values.get(col_index), styles.data)
+                    for col_index in range(2, column_count + 1)
+                ]
+            )
+
+
+# These run in worker processes, so they're given plain values rather than a
+#  generator or connect group to pickle
+
+
+def _render_sheet(field_list: List[str], title: str, rows: List[Dict[int, str]]):
+    return ConnectGroupWorksheetGenerator(field_list).render(title, rows)
+
+
+def _render_workbook(
+    field_list: List[str],
+    title: str,
+    rows: List[Dict[int, str]],
+    compresslevel: Optional[int],
+):
+    return ConnectGroupWorksheetGenerator(field_list).render_workbook(
+        title, rows, compresslevel
+    )
+
 
 class ConnectGroupWorkbookManager:
     """An excel workbook, with sheets per connect group and a summary sheet"""
 
     OUTPUT_FILENAME = "inc_cg.xlsx"
+    # Larger workbooks are spooled to a temporary file
+    SPOOL_MAX_BYTES = 32 * 1024 * 1024
 
     def __init__(
         self,
         membership_manager: ConnectGroupMembershipManager,
         worksheet_generator: ConnectGroupWorksheetGenerator,
+        write_only: bool = False,
+        processes: int = 1,
+        sheet_cache: Optional[SheetCache] = None,
+        compresslevel: Optional[int] = None,
     ):
         self._membership_manager = membership_manager
+        # See write_workbook()
+        self._compresslevel = compresslevel
         self._worksheet_generator = worksheet_generator
-        self._workbook = Workbook()
+        self._processes = processes
+        self._sheet_cache = sheet_cache
+        # Rendered sheets, whether from other processes or the sheet cache,
+        #  can only be added to a write-only workbook
+        self._render = processes > 1 or sheet_cache is not None
+        self._write_only = write_only or self._render
+        self._workbook = Workbook(write_only=self._write_only)
+        self.sheets_reused = 0
+        self.sheets_rebuilt = 0
 
     def insert_title_sheet(self) -> None:
         about_sheet = self._workbook.create_sheet("About", 0)
@@ -138,45 +391,52 @@ class ConnectGroupWorkbookManager:
         about_sheet.column_dimensions["A"].width = 30
         about_sheet.column_dimensions["B"].width = 40
         now_au = datetime.datetime.now(tz=ZoneInfo("Australia/Sydney"))
-        about_sheet.append({"A": "Created:", "B": now_au.ctime()})
+        # Rows are lists rather than {column: value} dicts, which write-only
+        #  sheets don't accept
+        about_sheet.append(["Created:", now_au.ctime()])
         about_sheet.append(
-            {
-                "A": "Connect Group Count:",
-                "B": self._membership_manager.connect_groups_count,
-            }
+            ["Connect Group Count:", self._membership_manager.connect_groups_count]
         )
         about_sheet.append(
-            {
-                "A": "Connect Group Total Member Count:",
-                "B": self._membership_manager.connect_groups_member_count,
-            }
+            [
+                "Connect Group Total Member Count:",
+                self._membership_manager.connect_groups_member_count,
+            ]
         )
         # Volunteer Counts:
         for (
             volunteer_role,
             role_count,
         ) in self._membership_manager.volunteer_count.items():
-            about_sheet.append(
-                {
-                    "A": f"Team size - {volunteer_role}:",
-                    "B": role_count,
-                }
-            )
+            about_sheet.append([f"Team size - {volunteer_role}:", role_count])
 
         # Show a list of ConnectGroups
         if self._membership_manager.connect_groups_member_count > 0:
             about_sheet.append(
-                {"A": "Connect Group List:", "B": self._workbook.worksheets[1].title}
+                ["Connect Group List:", self._workbook.worksheets[1].title]
             )
         # Ignore the zeroth worksheet (this about page), and the first worksheet
         #  that we printed in the line about
         for ws in self._workbook.worksheets[2:]:
-            about_sheet.append({"B": ws.title})
+            about_sheet.append([None, ws.title])
 
     def create(self) -> None:
-        for connect_group in sorted(
+        connect_groups = sorted(
             self._membership_manager.populated_connect_groups, key=lambda x: x.name
-        ):
+        )
+        if self._render:
+            self._add_rendered_sheets(connect_groups)
+            self.insert_title_sheet()
+            return
+
+        if self._write_only:
+            for connect_group in connect_groups:
+                ws = self._workbook.create_sheet(connect_group.name)
+                self._worksheet_generator.stream(ws, connect_group)
+            self.insert_title_sheet()
+            return
+
+        for connect_group in connect_groups:
             ws = self._workbook.create_sheet()
             self._worksheet_generator.populate(ws, connect_group)
             self._worksheet_generator.style(ws)
@@ -187,9 +447,104 @@ class ConnectGroupWorkbookManager:
         self._workbook.remove(self._workbook.worksheets[0])
         self.insert_title_sheet()
 
+    def _render_each(
+        self, render: Callable[..., bytes], connect_groups: List[ConnectGroup], *args
+    ) -> Generator[bytes, None, None]:
+        """render(field list, group name, member rows, *args) for each connect
+        group, in order, in a pool of processes if there's more than one"""
+        generator = self._worksheet_generator
+        field_list = generator.field_list
+        if self._processes == 1:
+            for cg in connect_groups:
+                yield render(field_list, cg.name, generator.member_rows(cg), *args)
+            return
+        with ProcessPoolExecutor(max_workers=self._processes) as executor:
+            yield from executor.map(
+                render,
+                repeat(field_list),
+                [cg.name for cg in connect_groups],
+                [generator.member_rows(cg) for cg in connect_groups],
+                *(repeat(arg) for arg in args),
+                chunksize=max(1, len(connect_groups) // (self._processes * 4)),
+            )
+
+    def group_workbooks(
+        self, names: Optional[Collection[str]] = None
+    ) -> Iterator[Tuple[ConnectGroup, bytes]]:
+        """Each populated connect group (or just those in names) with an xlsx
+        file of its own sheet, as they're rendered"""
+        connect_groups = sorted(
+            (
+                cg
+                for cg in self._membership_manager.populated_connect_groups
+                if names is None or cg.name in names
+            ),
+            key=lambda x: x.name,
+        )
+        return zip(
+            connect_groups,
+            self._render_each(_render_workbook, connect_groups, self._compresslevel),
+        )
+
+    def _add_rendered_sheets(self, connect_groups: List[ConnectGroup]) -> None:
+        """Adds each connect group's sheet to the workbook in order, taking
+        unchanged sheets from the sheet cache and rendering the rest"""
+        generator = self._worksheet_generator
+        cache = self._sheet_cache
+        keys: Dict[str, str] = {}
+        cached: Dict[str, bytes] = {}
+        if cache is not None:
+            for cg in connect_groups:
+                keys[cg.name] = generator.content_hash(cg)
+                if (xml := cache.get(keys[cg.name])) is not None:
+                    cached[cg.name] = xml
+        rendered = self._render_each(
+            _render_sheet, [cg for cg in connect_groups if cg.name not in cached]
+        )
+        for connect_group in connect_groups:
+            if (xml := cached.pop(connect_group.name, None)) is not None:
+                self.sheets_reused += 1
+            else:
+                xml = next(rendered)
+                self.sheets_rebuilt += 1
+                if cache is not None:
+                    cache.put(keys[connect_group.name], xml)
+            ws = PrewrittenSheet(self._workbook, connect_group.name, xml)
+            add_sheet(self._workbook, ws)
+            # Rendered sheets use ConnectGroupStyles' style ids, so they
+            #  must be the first styles this workbook resolves
+            generator.styles_for(ws)
+        # Shut down any worker processes
+        rendered.close()
+
+        if cache is not None:
+            cache.prune(keys.values())
+            logger.info(
+                "Workbook sheets: %d reused from the sheet cache, %d rebuilt",
+                self.sheets_reused,
+                self.sheets_rebuilt,
+            )
+
+    def write(self, out: IO[bytes]) -> None:
+        """Writes the workbook to out as an xlsx file"""
+        write_workbook(self._workbook, out, self._compresslevel)
+
+    def spool(self) -> IO[bytes]:
+        """The workbook as an xlsx file, which stays in memory unless it's
+        larger than SPOOL_MAX_BYTES
+
+        Before Python 3.11 a SpooledTemporaryFile has no seekable() or
+        readable(), so only read(), seek() and tell() should be relied on
+        (load it with openpyxl via a BytesIO, for instance).
+        """
+        out = SpooledTemporaryFile(max_size=self.SPOOL_MAX_BYTES)
+        self.write(out)
+        out.seek(0)
+        return out
+
     def save(self) -> pathlib.Path:
         output_file = NamedTemporaryFile(delete=False)
-        self._workbook.save(output_file.name)
-        output_file.close()
+        with output_file:
+            self.write(output_file)
         output_path = pathlib.Path(output_file.name)
         return output_path.rename(output_path.with_name(self.OUTPUT_FILENAME))
@@ -0,0 +1,415 @@
+"""A local stand-in for the parts of the PCO People API the reporter uses
+
+Serves a synthetic organisation from generate_organisation() so the reporter
+can be run (and timed) against tens of thousands of people without touching
+production. Point the app at it with PCO_API_BASE:
+
+    python -m inc_cg_reporter.fake_pco --people 50000 --connect-groups 500
+    PCO_API_BASE=http://127.0.0.1:8765 SEND_EMAIL=false \\
+        python -m inc_cg_reporter.app
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import daiquiri
+
+from inc_cg_reporter.field_definition import (
+    CONNECT_GROUP_FIELD_DEFINITION_NAME,
+    PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES,
+    PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES,
+)
+
+logger = daiquiri.getLogger(__name__)
+
+FIRST_NAMES = """Alice Ben Chloe Daniel Emily Finn Grace Hamish Isla Jack Kate Liam Mia
+    Noah Olivia Paul Ruby Sam Tess Will Zara Hannah James Lucy Matthew""".split()
+LAST_NAMES = """Smith Jones Williams Brown Wilson Taylor Nguyen Johnson Martin White
+    Anderson Walker Thompson Kelly Lee Ryan Chen Harris Lewis King Singh""".split()
+SUBURBS = """Epping Ryde Hornsby Chatswood Parramatta Manly Bondi Newtown Penrith
+    Cronulla Strathfield Narrabeen""".split()
+TEAMS = """Worship Kids Welcome Production Prayer Hospitality Youth Media
+    Care""".split()
+
+# (resource, updated_at); updated_at is only used for where[updated_at][gte]
+Record = Tuple[dict, str]
+
+
+@dataclass
+class FakeOrganisation:
+    field_definitions: List[Record] = field(default_factory=list)
+    field_data: List[Record] = field(default_factory=list)
+    people: List[Record] = field(default_factory=list)
+
+
+def generate_organisation(
+    people: int = 1000,
+    connect_groups: int = 50,
+    extra_field_definitions: int = 150,
+    seed: int = 0,
+) -> FakeOrganisation:
+    """A reproducible organisation shaped like the one the report is run for
+
+    Most people are in one connect group and a few are in two. Date fields
+    are filled in for some people, as are checkbox teams (one field datum
+    per team) and unrelated custom fields, so that unfiltered scans and
+    early-exit field definition scans do realistic amounts of work.
+    """
+    rng = random.Random(seed)
+    epoch = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def timestamp() -> str:
+        ts = epoch + datetime.timedelta(seconds=rng.randrange(3 * 365 * 24 * 3600))
+        return ts.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    org = FakeOrganisation()
+    extra_names = [f"Custom Field {i}" for i in range(extra_field_definitions)]
+    team_field_name = PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES[0]
+    definitions = (
+        [(CONNECT_GROUP_FIELD_DEFINITION_NAME, "string")]
+        + [(n, "date") for n in PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES]
+        + [
+            (n, "checkboxes")
+            for n in PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES
+        ]
+        + [(n, "string") for n in extra_names]
+    )
+    rng.shuffle(definitions)
+    ids_by_name: Dict[str, int] = {}
+    for field_id, (name, data_type) in enumerate(definitions, start=80_000):
+        ids_by_name[name] = field_id
+        resource = {
+            "type": "FieldDefinition",
+            "id": str(field_id),
+            "attributes": {"name": name, "data_type": data_type},
+        }
+        org.field_definitions.append((resource, timestamp()))
+
+    group_names = [
+        f"{rng.choice(SUBURBS)} CG {number}" for number in range(1, connect_groups + 1)
+    ]
+    datum_ids = iter(range(90_000_000, 1_000_000_000))
+
+    def add_datum(field_name: str, person_id: int, value: str, updated_at: str):
+        field_id = str(ids_by_name[field_name])
+        resource = {
+            "type": "FieldDatum",
+            "id": str(next(datum_ids)),
+            "attributes": {"value": value},
+            "relationships": {
+                "field_definition": {
+                    "data": {"type": "FieldDefinition", "id": field_id}
+                },
+                "customizable": {"data": {"type": "Person", "id": str(person_id)}},
+            },
+        }
+        org.field_data.append((resource, updated_at))
+
+    for person_id in range(2_000_000, 2_000_000 + people):
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        updated_at = timestamp()
+        resource = {
+            "type": "Person",
+            "id": str(person_id),
+            "attributes": {
+                "first_name": first_name,
+                "last_name": last_name,
+                "name": f"{first_name} {last_name}",
+                "updated_at": updated_at,
+            },
+        }
+        org.people.append((resource, updated_at))
+        if rng.random() < 0.8:
+            for name in rng.sample(group_names, 2 if rng.random() < 0.05 else 1):
+                add_datum(
+                    CONNECT_GROUP_FIELD_DEFINITION_NAME, person_id, name, updated_at
+                )
+        for name in PERSONAL_ATTRIBUTE_SINGLE_VALUE_FIELD_DEFINITION_NAMES:
+            if rng.random() < 0.4:
+                date = epoch - datetime.timedelta(days=rng.randrange(40 * 365))
+                add_datum(name, person_id, date.strftime("%d/%m/%Y"), updated_at)
+        if rng.random() < 0.3:
+            for team in rng.sample(TEAMS, rng.randint(1, 3)):
+                add_datum(team_field_name, person_id, team, updated_at)
+        if extra_names:
+            for name in rng.sample(
+                extra_names, min(len(extra_names), rng.randint(0, 3))
+            ):
+                add_datum(name, person_id, "Yes", updated_at)
+    return org
+
+
+class FakePCOServer:
+    """Serves a FakeOrganisation over HTTP the way PCO's People API does
+
+    Supports per_page (capped at 100) and offset pagination with links.next
+    and meta.total_count, where[id], where[field_definition_id] (both
+    comma-separated lists), where[updated_at][gte], order=[-]updated_at,
+    fields[...] sparse fieldsets and If-None-Match. Unsupported where[...]
+    filters and per_page or offset values that aren't whole numbers are
+    rejected with a 400, as PCO does.
+
+    latency seconds are added to every response, and every throttle_every'th
+    request is answered with a 429 and Retry-After: retry_after.
+    """
+
+    MAX_PER_PAGE = 100
+    DEFAULT_PER_PAGE = 25
+
+    def __init__(
+        self,
+        organisation: FakeOrganisation,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        throttle_every: int = 0,
+        retry_after: int = 1,
+    ):
+        self._resources: Dict[str, List[Record]] = {
+            "/people/v2/field_definitions": organisation.field_definitions,
+            "/people/v2/field_data": organisation.field_data,
+            "/people/v2/people": organisation.people,
+        }
+        self._positions_by_id = {
+            path: {
+                resource["id"]: position
+                for position, (resource, _) in enumerate(records)
+            }
+            for path, records in self._resources.items()
+        }
+        self._latency = latency
+        self._throttle_every = throttle_every
+        self._retry_after = retry_after
+        self._lock = threading.Lock()
+        self._matching_cache: Dict[Tuple[str, tuple], List[Record]] = {}
+        self.requests_served = 0
+        self.throttled = 0
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def start(self) -> "FakePCOServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("Fake PCO serving on %s", self.api_base)
+        return self
+
+    def serve_forever(self) -> None:
+        """Serves on the calling thread until interrupted"""
+        logger.info("Fake PCO serving on %s", self.api_base)
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self._httpd.server_close()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "FakePCOServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _throttle(self) -> bool:
+        with self._lock:
+            self.requests_served += 1
+            if (
+                self._throttle_every
+                and self.requests_served % self._throttle_every == 0
+            ):
+                self.throttled += 1
+                return True
+            return False
+
+    @staticmethod
+    def _filter(key: str, value: str) -> Optional[Callable[[Record], bool]]:
+        if key == "where[field_definition_id]":
+            ids = set(value.split(","))
+            return (
+                lambda record: record[0]["relationships"]["field_definition"]["data"][
+                    "id"
+                ]
+                in ids
+            )
+        if key == "where[updated_at][gte]":
+            return lambda record: record[1] >= value
+        return None
+
+    @staticmethod
+    def _sparse(resource: dict, fields: Optional[str]) -> dict:
+        if fields is None:
+            return resource
+        wanted = set(fields.split(","))
+        sparse = dict(resource)
+        for section in ("attributes", "relationships"):
+            if section in resource:
+                sparse[section] = {
+                    k: v for k, v in resource[section].items() if k in wanted
+                }
+        return sparse
+
+    @staticmethod
+    def _page_param(params: Dict[str, str], key: str, default: int, minimum: int):
+        value = params.get(key, str(default))
+        try:
+            number = int(value)
+        except ValueError:
+            number = minimum - 1
+        if number < minimum:
+            raise ValueError(f"Invalid {key} {value!r}")
+        return number
+
+    def _matching(self, path: str, params: Dict[str, str]) -> List[Record]:
+        """Records matching the where[...] filters and order, memoised so that
+        paging through a filtered scan doesn't refilter on every page"""
+        query = tuple(
+            sorted(
+                (key, value)
+                for key, value in params.items()
+                if key.startswith("where[") or key == "order"
+            )
+        )
+        with self._lock:
+            if (cached := self._matching_cache.get((path, query))) is not None:
+                return cached
+        records = self._resources[path]
+        filters = dict(query)
+        filters.pop("order", None)
+        if (ids := filters.pop("where[id]", None)) is not None:
+            # Look people up rather than scanning for them, keeping PCO's order
+            positions = self._positions_by_id[path]
+            records = [
+                records[position]
+                for position in sorted(
+                    positions[i] for i in set(ids.split(",")) if i in positions
+                )
+            ]
+        for key, value in filters.items():
+            if (predicate := self._filter(key, value)) is None:
+                raise ValueError(f"Invalid filter {key}")
+            records = [record for record in records if predicate(record)]
+        order = params.get("order")
+        if order in ("updated_at", "-updated_at"):
+            records = sorted(
+                records, key=lambda record: record[1], reverse=order.startswith("-")
+            )
+        with self._lock:
+            self._matching_cache[(path, query)] = records
+        return records
+
+    def respond(self, path: str, query: str) -> Tuple[int, dict]:
+        """(status, body) for a GET, without the HTTP layer"""
+        path = path.rstrip("/")
+        if path not in self._resources:
+            return 404, {"errors": [{"status": "404", "title": "Not Found"}]}
+        params = dict(parse_qsl(query))
+        try:
+            per_page = min(
+                self._page_param(params, "per_page", self.DEFAULT_PER_PAGE, 1),
+                self.MAX_PER_PAGE,
+            )
+            offset = self._page_param(params, "offset", 0, 0)
+            records = self._matching(path, params)
+        except ValueError as e:
+            return 400, {"errors": [{"status": "400", "title": str(e)}]}
+        page = records[offset : offset + per_page]
+        resource_type = page[0][0]["type"] if page else ""
+        fields = params.get(f"fields[{resource_type}]")
+        body: dict = {
+            "links": {"self": f"{self.api_base}{path}?{query}"},
+            "data": [self._sparse(resource, fields) for resource, _ in page],
+            "included": [],
+            "meta": {"total_count": len(records), "count": len(page)},
+        }
+        if offset + per_page < len(records):
+            next_params = {**params, "offset": str(offset + per_page)}
+            body["links"]["next"] = f"{self.api_base}{path}?{urlencode(next_params)}"
+            body["meta"]["next"] = {"offset": offset + per_page}
+        return 200, body
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if server._latency:
+                    time.sleep(server._latency)
+                if server._throttle():
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(server._retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                url = urlsplit(self.path)
+                status, body = server.respond(url.path, url.query)
+                content = json.dumps(body).encode()
+                etag = f'"{hashlib.sha1(content).hexdigest()}"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header("Content-Type", "application/vnd.api+json")
+                self.send_header("Content-Length", str(len(content)))
+                if status == 200:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug("Fake PCO: " + format, *args)
+
+        return Handler
+
+
+def main() -> None:
+    daiquiri.setup(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--people", type=int, default=1000)
+    parser.add_argument("--connect-groups", type=int, default=50)
+    parser.add_argument("--extra-field-definitions", type=int, default=150)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--throttle-every", type=int, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    organisation = generate_organisation(
+        args.people, args.connect_groups, args.extra_field_definitions, args.seed
+    )
+    logger.info(
+        "Generated %d people, %d field data, %d field definitions",
+        len(organisation.people),
+        len(organisation.field_data),
+        len(organisation.field_definitions),
+    )
+    server = FakePCOServer(
+        organisation,
+        port=args.port,
+        latency=args.latency,
+        throttle_every=args.throttle_every,
+        retry_after=args.retry_after,
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""A local SMTP sink for trying out email delivery without sending anything
+
+Accepts (and keeps) whatever is sent to it, with or without AUTH. STARTTLS
+isn't offered, so point the app at it with SMTP_STARTTLS=false:
+
+    python -m inc_cg_reporter.fake_smtp --port 8025
+    SMTP_HOST=127.0.0.1 SMTP_PORT=8025 SMTP_STARTTLS=false \\
+        python -m inc_cg_reporter.app
+"""
+
+import argparse
+import email
+import logging
+import socketserver
+import threading
+from dataclasses import dataclass
+from email.message import Message
+from typing import List, Optional
+
+import daiquiri
+
+logger = daiquiri.getLogger(__name__)
+
+
+@dataclass
+class ReceivedMessage:
+    mail_from: str
+    recipients: List[str]
+    message: Message
+
+
+class FakeSMTPServer:
+    """Speaks enough SMTP for smtplib's sendmail(), send_message() and login()
+
+    Every drop_every'th message is dropped: the connection is closed once
+    its DATA has been read, without a reply, as a flaky relay might.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, drop_every: int = 0):
+        self._drop_every = drop_every
+        self._lock = threading.Lock()
+        self.messages: List[ReceivedMessage] = []
+        self.connections = 0
+        self.dropped = 0
+        self._data_received = 0
+        self._server = socketserver.ThreadingTCPServer(
+            (host, port), self._make_handler()
+        )
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return str(host), int(port)
+
+    def start(self) -> "FakeSMTPServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("Fake SMTP listening on %s:%d", *self.address)
+        return self
+
+    def serve_forever(self) -> None:
+        """Serves on the calling thread until interrupted"""
+        logger.info("Fake SMTP listening on %s:%d", *self.address)
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self._server.server_close()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeSMTPServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _received(self, mail_from: str, recipients: List[str], data: bytes) -> bool:
+        """Keeps a message, unless it's one to drop"""
+        with self._lock:
+            self._data_received += 1
+            if self._drop_every and self._data_received % self._drop_every == 0:
+                self.dropped += 1
+                return False
+            message = email.message_from_bytes(data)
+            self.messages.append(ReceivedMessage(mail_from, recipients, message))
+        logger.info("Received %r for %s", message["Subject"], ", ".join(recipients))
+        return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line: str) -> None:
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def read_data(self) -> bytes:
+                lines = []
+                while (line := self.rfile.readline()) not in (b".\r\n", b""):
+                    # Undo dot-stuffing
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                return b"".join(lines)
+
+            @staticmethod
+            def address(argument: str) -> str:
+                # FROM:<address> or TO:<address>
+                return argument.partition(":")[2].strip().strip("<>")
+
+            def handle(self) -> None:
+                with server._lock:
+                    server.connections += 1
+                self.reply("220 fake-smtp ESMTP")
+                mail_from = ""
+                recipients: List[str] = []
+                while line := self.rfile.readline():
+                    command, _, argument = line.decode().strip().partition(" ")
+                    command = command.upper()
+                    if command == "EHLO":
+                        self.reply("250-fake-smtp")
+                        self.reply("250 AUTH PLAIN")
+                    elif command == "HELO":
+                        self.reply("250 fake-smtp")
+                    elif command == "AUTH":
+                        self.reply("235 Authentication successful")
+                    elif command == "MAIL":
+                        mail_from, recipients = self.address(argument), []
+                        self.reply("250 OK")
+                    elif command == "RCPT":
+                        recipients.append(self.address(argument))
+                        self.reply("250 OK")
+                    elif command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        if not server._received(
+                            mail_from, recipients, self.read_data()
+                        ):
+                            return
+                        self.reply("250 OK")
+                    elif command in ("RSET", "NOOP"):
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        return Handler
+
+
+def main() -> None:
+    daiquiri.setup(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--drop-every", type=int, default=0)
+    args = parser.parse_args()
+    FakeSMTPServer(port=args.port, drop_every=args.drop_every).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
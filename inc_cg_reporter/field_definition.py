@@ -1,19 +1,28 @@
 from __future__ import annotations
-import logging
-from typing import Dict, List, Callable
+import json
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Callable, Optional, Tuple, Union
 
 import daiquiri
 import pypco
+from more_itertools import chunked
 
 from typing import TYPE_CHECKING
 
+from inc_cg_reporter.pagination import OffsetPaginator
+from inc_cg_reporter.snapshot import FieldDataSnapshot, FieldDatumRow
+
+# (field definition id, person id, value)
+FieldValue = Tuple[int, int, str]
+
 if TYPE_CHECKING:
     from inc_cg_reporter.connect_group import (
         ConnectGroupMembershipManager,
         PersonManager,
     )
 
-daiquiri.setup(level=logging.INFO)
 logger = daiquiri.getLogger(__name__)
 
 
@@ -35,12 +44,54 @@ PERSONAL_ATTRIBUTE_MULTI_VALUE_FIELD_DEFINITION_NAMES = [
 ]
 
 
+class FieldDefinitionCache:
+    """On-disk copy of the field definition name to id map
+
+    Field definition ids practically never change, so there's no need to page
+    through every definition in the organisation on each run.
+    """
+
+    DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+
+    def __init__(self, path: pathlib.Path, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self._path = path
+        self._ttl_seconds = ttl_seconds
+
+    def load(self) -> Optional[Dict[str, int]]:
+        """Returns the cached map, or None if it's missing, unreadable or expired"""
+        try:
+            cached = json.loads(self._path.read_text())
+            fetched_at = float(cached["fetched_at"])
+            field_defs = {str(k): int(v) for k, v in cached["field_defs"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.info("No usable field definition cache at %s (%s)", self._path, e)
+            return None
+
+        age = time.time() - fetched_at
+        if age > self._ttl_seconds:
+            logger.info("Field definition cache expired (%d seconds old)", age)
+            return None
+        return field_defs
+
+    def store(self, field_defs: Dict[str, int]) -> None:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.write_text(
+            json.dumps({"fetched_at": time.time(), "field_defs": field_defs})
+        )
+
+
 class PlanningCentreFieldDefinitionMapper:
     """Maps planning centre field definition ids to readable field names"""
 
-    def __init__(self, pco: pypco.PCO, field_names: List[str]):
+    def __init__(
+        self,
+        pco: pypco.PCO,
+        field_names: List[str],
+        cache: Optional[FieldDefinitionCache] = None,
+    ):
         self.__pco = pco
         self._field_names = field_names
+        self._cache = cache
         self.field_defs_id_by_name: Dict[str, int] = {}
         self.field_defs_name_by_id: Dict[int, str] = {}
 
@@ -89,12 +140,40 @@ class PlanningCentreFieldDefinitionMapper:
 
         return field_defs
 
-    def build_map(self):
-        self.field_defs_id_by_name = self.get_field_definition_ids()
+    def cached_ids_are_current(self, cached: Dict[str, int]) -> bool:
+        """Checks cached ids against PCO with a single request for just those ids"""
+        if set(cached) != set(self._field_names):
+            return False
+        response = self.__pco.get(
+            "/people/v2/field_definitions",
+            per_page=100,
+            **{"where[id]": ",".join(str(i) for i in sorted(cached.values()))},
+        )
+        current = {
+            int(datum["id"]): datum["attributes"]["name"].strip()
+            for datum in response["data"]
+        }
+        return all(current.get(i) == name for name, i in cached.items())
+
+    def build_map(self) -> bool:
+        """Populates the maps, returning True if they were served from the cache"""
+        from_cache = False
+        cached = self._cache.load() if self._cache else None
+        if cached is not None and self.cached_ids_are_current(cached):
+            logger.info("Using cached field definitions")
+            self.field_defs_id_by_name = cached
+            from_cache = True
+        else:
+            if cached is not None:
+                logger.info("Cached field definitions are stale; refetching")
+            self.field_defs_id_by_name = self.get_field_definition_ids()
+            if self._cache:
+                self._cache.store(self.field_defs_id_by_name)
         logger.info(self.field_defs_id_by_name)
         self.field_defs_name_by_id = {
             v: k for k, v in self.field_defs_id_by_name.items()
         }
+        return from_cache
 
 
 class PlanningCentreFieldHandler:
@@ -102,13 +181,25 @@ class PlanningCentreFieldHandler:
 
     def __init__(self, pcfdm: PlanningCentreFieldDefinitionMapper):
         self._field_handler_map: Dict[int, Callable[[str, str, int], None]] = {}
+        self._field_bulk_handler_map: Dict[
+            int, Callable[[str, Iterable[Tuple[int, str]]], None]
+        ] = {}
         self._field_definition_mapper = pcfdm
 
     def register_method(
-        self, field_name: str, handler: Callable[[str, str, int], None]
+        self,
+        field_name: str,
+        handler: Callable[[str, str, int], None],
+        bulk_handler: Optional[Callable[[str, Iterable[Tuple[int, str]]], None]] = None,
     ):
+        """Registers a handler, and optionally a bulk equivalent for dispatch_batch
+
+        A bulk handler receives the field name and (person_id, value) pairs.
+        """
         field_id = self._field_definition_mapper.field_defs_id_by_name[field_name]
         self._field_handler_map[field_id] = handler
+        if bulk_handler:
+            self._field_bulk_handler_map[field_id] = bulk_handler
 
     @property
     def registered_field_ids(self) -> List[int]:
@@ -122,8 +213,105 @@ class PlanningCentreFieldHandler:
         ) :
             self._field_handler_map[field_id](field_name, field_value, person_id)
 
+    def dispatch_batch(self, field_id: int, records: List[Tuple[int, str]]):
+        """Dispatches (person_id, value) pairs that all belong to one field
+
+        The field name and handler are only looked up once for the batch.
+        """
+        if not (
+            field_name := self._field_definition_mapper.field_defs_name_by_id.get(
+                field_id
+            )
+        ):
+            return
+        if bulk_handler := self._field_bulk_handler_map.get(field_id):
+            bulk_handler(field_name, records)
+        else:
+            handler = self._field_handler_map[field_id]
+            for person_id, field_value in records:
+                handler(field_name, field_value, person_id)
+
+
+class FieldDataQueryPlanner:
+    """Picks the cheapest way to fetch field data for a set of field ids
+
+    Field data can be fetched with one filtered query per field, a single
+    query filtered on a comma separated list of ids, or an unfiltered scan of
+    every datum (leaving the caller to discard the ones it doesn't track).
+    Which costs the fewest pages depends on how much of the organisation's
+    field data we track, so probe each plan's meta.total_count and compare.
+    """
+
+    PER_FIELD = "per_field"
+    BATCHED = "batched"
+    UNFILTERED = "unfiltered"
+    AUTO = "auto"
+    # In order of preference when costs are tied
+    PLANS = [PER_FIELD, BATCHED, UNFILTERED]
+
+    def __init__(self, pco: pypco.PCO, max_workers: int = 1, per_page: int = 100):
+        self._paginator = OffsetPaginator(pco, per_page=per_page)
+        self._max_workers = max_workers
+        self._per_page = per_page
+
+    def _pages(self, record_count: int) -> int:
+        return -(-record_count // self._per_page)
+
+    def estimate_costs(self, field_ids: List[int]) -> Dict[str, int]:
+        """Estimated page requests for each usable plan"""
+        url = "/people/v2/field_data"
+        with ThreadPoolExecutor(max_workers=max(1, self._max_workers)) as executor:
+            per_field_counts = list(
+                executor.map(
+                    lambda f: self._paginator.total_count(
+                        url, **{"where[field_definition_id]": f}
+                    ),
+                    field_ids,
+                )
+            )
+        batched_count = self._paginator.total_count(
+            url, **{"where[field_definition_id]": ",".join(map(str, field_ids))}
+        )
+        unfiltered_count = self._paginator.total_count(url)
+
+        costs = {
+            self.PER_FIELD: sum(self._pages(c) for c in per_field_counts),
+            self.UNFILTERED: self._pages(unfiltered_count),
+        }
+        # If PCO doesn't honour the id list we'd silently get the wrong
+        #  records, so only consider it when it adds up.
+        if batched_count == sum(per_field_counts):
+            costs[self.BATCHED] = self._pages(batched_count)
+        else:
+            logger.info(
+                "Batched field data query returned %d records, expected %d; "
+                "not considering it",
+                batched_count,
+                sum(per_field_counts),
+            )
+        return costs
+
+    def choose(self, field_ids: List[int]) -> str:
+        costs = self.estimate_costs(field_ids)
+        plan = min(
+            (p for p in self.PLANS if p in costs),
+            key=lambda p: (costs[p], self.PLANS.index(p)),
+        )
+        logger.info(
+            "Field data query plan: %s (estimated %d pages; %s)",
+            plan,
+            costs[plan],
+            ", ".join(f"{p}={c}" for p, c in costs.items()),
+        )
+        return plan
+
 
 class FieldDataProcessor:
+
+    DISPATCH_BATCH_SIZE = 100
+    # We only read the value and who it belongs to (and which field it's for)
+    SPARSE_FIELDSET = {"fields[FieldDatum]": "value,customizable,field_definition"}
+
     def __init__(
         self,
         pco: pypco.PCO,
@@ -132,6 +320,13 @@ class FieldDataProcessor:
         personal_attribute_multi_value_field_names: List[str],
         pm: PersonManager,
         cgm: ConnectGroupMembershipManager,
+        max_workers: int = 1,
+        page_workers: int = 1,
+        field_definition_cache: Optional[FieldDefinitionCache] = None,
+        snapshot: Optional[FieldDataSnapshot] = None,
+        full_resync: bool = True,
+        plan: str = FieldDataQueryPlanner.PER_FIELD,
+        lean: bool = False,
     ):
         self.__pco = pco
         self.__connect_group_field_name = connect_group_field_name
@@ -143,49 +338,232 @@ class FieldDataProcessor:
         )
         self.__pm = pm
         self.__cgm = cgm
+        self.__max_workers = max_workers
+        self.__page_workers = page_workers
+        self.__field_definition_cache = field_definition_cache
+        self.__snapshot = snapshot
+        self.__full_resync = full_resync
+        self.__plan = plan
+        self.__lean = lean
+        self.records_dispatched = 0
+
+    def _iterate_field_data(
+        self, field_id: Optional[Union[int, str]], **params
+    ) -> Iterator[dict]:
+        if field_id is not None:
+            params["where[field_definition_id]"] = field_id
+        if self.__page_workers > 1:
+            return OffsetPaginator(self.__pco, self.__page_workers).iterate(
+                "/people/v2/field_data", **params
+            )
+        data: Iterator[dict] = self.__pco.iterate(
+            "/people/v2/field_data", per_page=100, **params
+        )
+        return data
+
+    @staticmethod
+    def _decode_datum(item: dict) -> FieldValue:
+        relationships = item["relationships"]
+        return (
+            int(relationships["field_definition"]["data"]["id"]),
+            int(relationships["customizable"]["data"]["id"]),
+            item["attributes"]["value"],
+        )
+
+    @classmethod
+    def _decode_page(cls, page: dict) -> List[FieldValue]:
+        return [cls._decode_datum(item) for item in page["data"]]
+
+    def _iterate_field_values(
+        self, field_id: Optional[Union[int, str]]
+    ) -> Iterator[FieldValue]:
+        if not self.__lean:
+            for datum in self._iterate_field_data(field_id):
+                yield self._decode_datum(datum["data"])
+            return
+        # Decode each page straight into tuples, skipping the per-record
+        #  wrapper dicts pypco builds, and let the page go as soon as possible
+        params = dict(self.SPARSE_FIELDSET)
+        if field_id is not None:
+            params["where[field_definition_id]"] = str(field_id)
+        for page in OffsetPaginator(self.__pco, self.__page_workers).pages(
+            "/people/v2/field_data", **params
+        ):
+            yield from self._decode_page(page)
+
+    def _fetch_field_values(self, field_id: int) -> List[Tuple[int, str]]:
+        # Drain the whole scan so it can run on a worker thread
+        return [(pid, value) for _, pid, value in self._iterate_field_values(field_id)]
+
+    @staticmethod
+    def _snapshot_rows(data: Iterable[dict]) -> Iterator[FieldDatumRow]:
+        for datum in data:
+            person_id = datum["data"]["relationships"]["customizable"]["data"]["id"]
+            yield int(datum["data"]["id"]), int(person_id), datum["data"]["attributes"][
+                "value"
+            ]
+
+    def _fetch_field_data_in_one_query(
+        self, field_ids: List[int], plan: str
+    ) -> List[List[Tuple[int, str]]]:
+        """Fetches data for all fields with a single (batched or unfiltered) scan
+
+        Values are grouped back by field so they're dispatched in the same
+        order as the per-field plan.
+        """
+        query_filter = (
+            None
+            if plan == FieldDataQueryPlanner.UNFILTERED
+            else ",".join(str(field_id) for field_id in field_ids)
+        )
+        values_by_field: Dict[int, List[Tuple[int, str]]] = {f: [] for f in field_ids}
+        for field_id, person_id, value in self._iterate_field_values(query_filter):
+            if (values := values_by_field.get(field_id)) is not None:
+                values.append((person_id, value))
+        return [values_by_field[field_id] for field_id in field_ids]
+
+    def _fetch_field_data_changes(
+        self, field_id: int, since: Optional[str]
+    ) -> Tuple[Optional[int], List[dict]]:
+        """Field data updated since a sync time, plus the field's current total
+
+        With no sync time, returns every datum for the field and no total.
+        """
+        if since is None:
+            return None, list(self._iterate_field_data(field_id))
+        changed = list(
+            self._iterate_field_data(
+                field_id, order="updated_at", **{"where[updated_at][gte]": since}
+            )
+        )
+        total_count = OffsetPaginator(self.__pco).total_count(
+            "/people/v2/field_data", **{"where[field_definition_id]": field_id}
+        )
+        return total_count, changed
+
+    def _sync_snapshot(
+        self, executor: ThreadPoolExecutor, field_ids: List[int]
+    ) -> List[List[Tuple[int, str]]]:
+        snapshot = self.__snapshot
+        assert snapshot is not None
+        since_by_id = {
+            field_id: (
+                None if self.__full_resync else snapshot.field_data_synced_at(field_id)
+            )
+            for field_id in field_ids
+        }
+        # Fetching happens on the pool; SQLite is only touched from this thread
+        for field_id, (total_count, data) in zip(
+            field_ids,
+            executor.map(
+                lambda f: self._fetch_field_data_changes(f, since_by_id[f]), field_ids
+            ),
+        ):
+            if total_count is None:
+                snapshot.replace_field_data(field_id, self._snapshot_rows(data))
+                continue
+            snapshot.upsert_field_data(field_id, self._snapshot_rows(data))
+            local_count = snapshot.field_data_count(field_id)
+            logger.info(
+                "  Field %s: %d changed records since %s",
+                field_id,
+                len(data),
+                since_by_id[field_id],
+            )
+            if local_count != total_count:
+                # Deleted data doesn't show up as an update, but it does show
+                #  up in the count. Rescan the field to find out what went.
+                logger.info(
+                    "  Field %s: snapshot has %d records but PCO has %d; rescanning",
+                    field_id,
+                    local_count,
+                    total_count,
+                )
+                snapshot.replace_field_data(
+                    field_id, self._snapshot_rows(self._iterate_field_data(field_id))
+                )
+        return [snapshot.field_data(field_id) for field_id in field_ids]
 
     def process_field_data(self, field_dispatcher):
         field_ids = field_dispatcher.registered_field_ids
+        workers = max(1, min(self.__max_workers, len(field_ids)))
         logger.info(
-            "Fetching field data for %d field definitions (filtered)", len(field_ids)
+            "Fetching field data for %d field definitions (filtered, %d workers)",
+            len(field_ids),
+            workers,
         )
         total_records = 0
-        for field_id in field_ids:
-            field_name = field_dispatcher._field_definition_mapper.field_defs_name_by_id.get(
-                field_id, str(field_id)
-            )
-            count = 0
-            for datum in self.__pco.iterate(
-                "/people/v2/field_data",
-                per_page=100,
-                **{"where[field_definition_id]": field_id},
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Fields are fetched concurrently, but map() hands back results in
+            #  field_ids order and dispatch only happens on this thread, so the
+            #  managers see exactly the same sequence of calls as a serial run.
+            plan = self.__plan
+            if plan == FieldDataQueryPlanner.AUTO and self.__snapshot is None:
+                plan = FieldDataQueryPlanner(self.__pco, workers).choose(field_ids)
+            field_values: Iterable[Iterable[Tuple[int, str]]]
+            if self.__snapshot is not None:
+                field_values = self._sync_snapshot(executor, field_ids)
+            elif plan in (
+                FieldDataQueryPlanner.BATCHED,
+                FieldDataQueryPlanner.UNFILTERED,
             ):
-                person_id = datum["data"]["relationships"]["customizable"]["data"]["id"]
-                field_value = datum["data"]["attributes"]["value"]
-                field_dispatcher.dispatch_field(field_id, field_value, int(person_id))
-                count += 1
-            logger.info("  %s (%s): %d records", field_name, field_id, count)
-            total_records += count
+                field_values = self._fetch_field_data_in_one_query(field_ids, plan)
+            elif workers > 1:
+                field_values = executor.map(self._fetch_field_values, field_ids)
+            else:
+                field_values = (
+                    ((pid, value) for _, pid, value in self._iterate_field_values(f))
+                    for f in field_ids
+                )
+            for field_id, values in zip(field_ids, field_values):
+                field_name = (
+                    field_dispatcher._field_definition_mapper.field_defs_name_by_id.get(
+                        field_id, str(field_id)
+                    )
+                )
+                count = 0
+                for batch in chunked(values, self.DISPATCH_BATCH_SIZE):
+                    field_dispatcher.dispatch_batch(field_id, batch)
+                    count += len(batch)
+                logger.info("  %s (%s): %d records", field_name, field_id, count)
+                total_records += count
+        self.records_dispatched += total_records
         logger.info(
             "Finished fetching field data: %d records across %d fields",
             total_records,
             len(field_ids),
         )
 
-    def process(self):
+    def build_field_handler(self) -> PlanningCentreFieldHandler:
+        """Maps the field names to ids and registers a handler for each"""
         field_definition_mapper = PlanningCentreFieldDefinitionMapper(
             self.__pco,
             [self.__connect_group_field_name]
             + self.__personal_attribute_single_value_field_names
             + self.__personal_attribute_multi_value_field_names,
+            self.__field_definition_cache,
         )
         logger.info("Building map")
         field_definition_mapper.build_map()
         field_handler = PlanningCentreFieldHandler(field_definition_mapper)
-        field_handler.register_method(self.__connect_group_field_name, self.__cgm.add)
+        field_handler.register_method(
+            self.__connect_group_field_name,
+            self.__cgm.add,
+            self.__cgm.add_members_bulk,
+        )
         for paf_name in self.__personal_attribute_single_value_field_names:
-            field_handler.register_method(paf_name, self.__pm.add_attribute)
+            field_handler.register_method(
+                paf_name, self.__pm.add_attribute, self.__pm.add_attributes_bulk
+            )
         for paf_name in self.__personal_attribute_multi_value_field_names:
-            field_handler.register_method(paf_name, self.__pm.add_or_extend_attribute)
+            field_handler.register_method(
+                paf_name,
+                self.__pm.add_or_extend_attribute,
+                self.__pm.add_or_extend_attributes_bulk,
+            )
+        return field_handler
+
+    def process(self):
+        field_handler = self.build_field_handler()
         logger.info("Processing field data")
         self.process_field_data(field_handler)
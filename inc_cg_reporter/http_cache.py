@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import daiquiri
+import pypco
+import requests
+
+logger = daiquiri.getLogger(__name__)
+
+
+class HTTPCache:
+    """On-disk cache of PCO GET responses, revalidated with conditional requests
+
+    Sits between a PCO client and its requests.Session. Responses carrying an
+    ETag or Last-Modified are stored, and the next request for the same URL
+    sends If-None-Match/If-Modified-Since; a 304 is answered from disk as
+    though PCO had sent the body again. Every request still goes to PCO, so
+    the cache never serves anything PCO hasn't just confirmed is current.
+
+    Once the stored bodies exceed max_bytes, the least recently used are
+    deleted.
+    """
+
+    DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+    # Response headers replayed on a cache hit
+    STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._session: Optional[requests.Session] = None
+        self._lock = threading.Lock()
+        # cache key -> (size, last used), for eviction
+        self._index: Dict[str, Tuple[int, float]] = {}
+        for entry in directory.glob("*.json"):
+            stat = entry.stat()
+            self._index[entry.stem] = (stat.st_size, stat.st_mtime)
+        self._size = sum(size for size, _ in self._index.values())
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def install(self, pco: pypco.PCO) -> None:
+        """Routes pco's requests through this cache"""
+        self._session = pco.session
+        pco.session = self
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self._directory / f"{key}.json"
+
+    def _load(self, key: str) -> Optional[dict]:
+        try:
+            entry: dict = json.loads(self._path(key).read_text())
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _store(self, key: str, response: requests.Response) -> None:
+        entry = {
+            "headers": {
+                name: response.headers[name]
+                for name in self.STORED_HEADERS
+                if name in response.headers
+            },
+            "body": response.text,
+        }
+        path = self._path(key)
+        path.write_text(json.dumps(entry))
+        with self._lock:
+            self._touch(key, path.stat().st_size)
+            self._evict()
+
+    def _touch(self, key: str, size: int) -> None:
+        """Records key as just used; its file's mtime keeps that across runs"""
+        previous_size, _ = self._index.get(key, (0, 0.0))
+        self._size += size - previous_size
+        self._index[key] = (size, time.time())
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        if self._size <= self._max_bytes:
+            return
+        for key, (size, _) in sorted(self._index.items(), key=lambda i: i[1][1]):
+            if self._size <= self._max_bytes:
+                break
+            self._path(key).unlink(missing_ok=True)
+            del self._index[key]
+            self._size -= size
+            logger.debug("Evicted %s from HTTP cache", key)
+
+    @staticmethod
+    def _key(method: str, url: str, params) -> str:
+        prepared = requests.Request(method, url, params=params).prepare()
+        return hashlib.sha256(str(prepared.url).encode()).hexdigest()
+
+    @staticmethod
+    def _replay(entry: dict, url: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers.update(entry["headers"])
+        response.encoding = "utf-8"
+        response._content = entry["body"].encode("utf-8")
+        # As requests-cache marks them, so the scheduler above can tell a
+        #  replayed body from a downloaded one
+        response.from_cache = True  # type: ignore[attr-defined]
+        return response
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        assert self._session is not None, "install() was not called"
+        if method.upper() != "GET":
+            return self._session.request(method, url, **kwargs)
+
+        key = self._key(method, url, kwargs.get("params"))
+        entry = self._load(key)
+        if entry is not None:
+            headers = dict(kwargs.get("headers") or {})
+            if etag := entry["headers"].get("ETag"):
+                headers["If-None-Match"] = etag
+            if last_modified := entry["headers"].get("Last-Modified"):
+                headers["If-Modified-Since"] = last_modified
+            kwargs["headers"] = headers
+
+        response = self._session.request(method, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            replayed = self._replay(entry, url)
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += len(replayed.content)
+                if key in self._index:
+                    self._touch(key, self._index[key][0])
+            return replayed
+
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200 and (
+            "ETag" in response.headers or "Last-Modified" in response.headers
+        ):
+            self._store(key, response)
+        return response
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+
+    def log_stats(self) -> None:
+        logger.info(
+            "HTTP cache: %d hits, %d misses, %d bytes not downloaded,"
+            " %d entries (%d bytes) stored",
+            self.hits,
+            self.misses,
+            self.bytes_saved,
+            len(self._index),
+            self._size,
+        )
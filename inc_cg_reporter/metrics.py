@@ -0,0 +1,128 @@
+import datetime
+import json
+import os
+import pathlib
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Iterator, Optional
+
+import daiquiri
+
+if TYPE_CHECKING:
+    from inc_cg_reporter.profiling import PhaseProfiler
+
+logger = daiquiri.getLogger(__name__)
+
+
+def peak_rss_kb() -> int:
+    """The process's peak resident set size so far, in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _write_atomically(path: pathlib.Path, text: str) -> None:
+    # Readers (e.g. node_exporter's textfile collector) never see a partial file
+    partial = path.with_name(f".{path.name}.{os.getpid()}")
+    partial.write_text(text)
+    partial.replace(path)
+
+
+class RunMetrics:
+    """Phase timings and counters for one run of the reporter
+
+    Written as a JSON run report, and optionally as a Prometheus textfile
+    collector file so scheduled runs can be charted and alerted on. Phases
+    are also profiled by profiler, if there is one.
+    """
+
+    PROMETHEUS_PREFIX = "inc_cg_reporter"
+
+    def __init__(self, profiler: Optional["PhaseProfiler"] = None):
+        self._profiler = profiler
+        self.started_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        self._start = time.perf_counter()
+        # phase name -> {"seconds", "peak_rss_kb"}, in the order they ran
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.succeeded = False
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            if self._profiler is None:
+                yield
+            else:
+                with self._profiler.profile(name):
+                    yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.phases[name] = {
+                "seconds": round(seconds, 4),
+                "peak_rss_kb": peak_rss_kb(),
+            }
+            logger.info("Phase %s took %.2fs", name, seconds)
+
+    def record(self, **counters: int) -> None:
+        self.counters.update(counters)
+
+    def report(self) -> dict:
+        return {
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(time.perf_counter() - self._start, 4),
+            "succeeded": self.succeeded,
+            "peak_rss_kb": peak_rss_kb(),
+            "phases": self.phases,
+            "counters": self.counters,
+        }
+
+    def write_json(self, path: pathlib.Path) -> None:
+        _write_atomically(path, json.dumps(self.report(), indent=2) + "\n")
+        logger.info("Run report written to %s", path)
+
+    def prometheus_text(self) -> str:
+        report = self.report()
+        prefix = self.PROMETHEUS_PREFIX
+        lines = []
+
+        def gauge(name: str, help_text: str, samples: Dict[str, float]) -> None:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples.items():
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        gauge(
+            "last_run_timestamp_seconds",
+            "When the last run started",
+            {"": self.started_at.timestamp()},
+        )
+        gauge(
+            "last_run_success",
+            "Whether the last run finished without error",
+            {"": int(self.succeeded)},
+        )
+        gauge("run_seconds", "Wall time of the last run", {"": report["seconds"]})
+        gauge(
+            "peak_rss_bytes",
+            "Peak resident set size of the last run",
+            {"": report["peak_rss_kb"] * 1024},
+        )
+        gauge(
+            "phase_seconds",
+            "Wall time of each phase of the last run",
+            {f'{{phase="{name}"}}': p["seconds"] for name, p in self.phases.items()},
+        )
+        for name, value in self.counters.items():
+            gauge(
+                name,
+                f"{name.replace('_', ' ').capitalize()} in the last run",
+                {"": value},
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: pathlib.Path) -> None:
+        _write_atomically(path, self.prometheus_text())
+        logger.info("Prometheus metrics written to %s", path)
@@ -0,0 +1,131 @@
+import json
+import pathlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple
+
+import daiquiri
+
+logger = daiquiri.getLogger(__name__)
+
+
+class PersonNameCache:
+    """Persistent person id to name cache with LRU and TTL eviction
+
+    Each entry keeps PCO's updated_at for the person. Every run, people
+    updated in PCO since the previous run are passed to refresh (see
+    refreshed_at), so renames are picked up straight away. Deleted people
+    don't show up as updated, so entries older than the TTL are treated as
+    missing and fetched (and confirmed to still exist) again; until then a
+    deleted person whose connect group field data lingers stays on the
+    report. Once there are more than max_entries, the least recently used
+    entries are dropped when saving.
+    """
+
+    DEFAULT_TTL_SECONDS = 24 * 60 * 60
+    DEFAULT_MAX_ENTRIES = 50_000
+    # Allows for our clock being ahead of PCO's
+    REFRESH_MARGIN = timedelta(hours=1)
+
+    def __init__(
+        self,
+        path: Optional[pathlib.Path] = None,
+        ttl_seconds: int = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        self._path = path
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        # person id -> (name, PCO's updated_at, time we fetched it), oldest first
+        self._entries: "OrderedDict[int, Tuple[str, Optional[str], float]]" = (
+            OrderedDict()
+        )
+        self._refreshed_at: Optional[str] = None
+        # Saved as the next refreshed_at: anything updated in PCO after this is
+        #  either fetched or refreshed this run, or caught by the next refresh
+        self._run_started_at = (
+            datetime.now(timezone.utc) - self.REFRESH_MARGIN
+        ).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self._load(path)
+
+    def _load(self, path: pathlib.Path) -> None:
+        try:
+            saved = json.loads(path.read_text())
+            entries = OrderedDict(
+                (int(pid), (str(name), updated_at, float(fetched_at)))
+                for pid, name, updated_at, fetched_at in saved["entries"]
+            )
+            refreshed_at = str(saved["refreshed_at"])
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.info("No usable person name cache at %s (%s)", path, e)
+            return
+        self._entries = entries
+        self._refreshed_at = refreshed_at
+        logger.info("Loaded %d cached names from %s", len(self._entries), path)
+
+    @property
+    def refreshed_at(self) -> Optional[str]:
+        """When the previous run started, in PCO's format; pass people updated
+        since then to refresh. None if there's nothing cached to refresh."""
+        return self._refreshed_at if self._entries else None
+
+    def refresh(self, people: Iterable[Tuple[int, str, Optional[str]]]) -> int:
+        """Updates cached names from (id, name, updated_at) of people updated in
+        PCO, returning how many cached names changed"""
+        renamed = 0
+        for person_id, name, updated_at in people:
+            entry = self._entries.get(person_id)
+            if entry is None or (updated_at or "") < (entry[1] or ""):
+                continue
+            if name != entry[0]:
+                renamed += 1
+            self._entries[person_id] = (name, updated_at, time.time())
+        return renamed
+
+    def get(self, person_id: int) -> Optional[str]:
+        """The cached name, or None if it's not cached or has expired"""
+        entry = self._entries.get(person_id)
+        if entry is None or time.time() - entry[2] > self._ttl_seconds:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(person_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, person_id: int, name: str, updated_at: Optional[str] = None):
+        self._entries[person_id] = (name, updated_at, time.time())
+        self._entries.move_to_end(person_id)
+
+    def invalidate(self, person_id: int) -> None:
+        """Forget a person, e.g. because PCO no longer has a record of them"""
+        self._entries.pop(person_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def save(self) -> None:
+        """Saves the cache; call once its entries have been refreshed (if
+        refreshed_at wasn't None) and fetched for this run"""
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        if self._path is None:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.write_text(
+            json.dumps(
+                {
+                    "refreshed_at": self._run_started_at,
+                    "entries": [[pid, *entry] for pid, entry in self._entries.items()],
+                }
+            )
+        )
+        logger.info(
+            "Saved %d cached names (%d hits, %d misses this run)",
+            len(self._entries),
+            self.hits,
+            self.misses,
+        )
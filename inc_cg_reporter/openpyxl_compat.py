@@ -0,0 +1,79 @@
+"""The openpyxl internals excel_writer relies on, kept in one place
+
+Rendering sheets in other processes (see ConnectGroupWorksheetGenerator.render())
+and sharing cell styles (see ConnectGroupStyles) need hooks openpyxl doesn't
+make public. The style hooks rely on a cell's style being a StyleArray of
+indexes into the workbook's style tables, whose position in the workbook's
+_cell_styles list becomes its style id. They're known to work with openpyxl
+3.0 and 3.1, and test_openpyxl_internals checks each of them against the
+installed openpyxl, so a release that changes them fails the tests rather than
+the reports.
+"""
+
+import os
+import pathlib
+from copy import copy
+from typing import Union
+
+from openpyxl import Workbook
+from openpyxl.cell import Cell, MergedCell, WriteOnlyCell
+from openpyxl.packaging.relationship import RelationshipList
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.worksheet._write_only import WriteOnlyWorksheet
+from openpyxl.worksheet._writer import ALL_TEMP_FILES, create_temporary_file
+
+
+def take_sheet_xml(ws: WriteOnlyWorksheet) -> bytes:
+    """The XML of a closed write-only sheet, which openpyxl leaves in its
+    writer's temporary file, deleting the file"""
+    try:
+        return pathlib.Path(ws._writer.out).read_bytes()
+    finally:
+        ws._writer.cleanup()
+
+
+class _PrewrittenSheetWriter:
+    """Stands in for openpyxl's WorksheetWriter when saving a PrewrittenSheet"""
+
+    def __init__(self, xml: bytes):
+        self.out = create_temporary_file()
+        pathlib.Path(self.out).write_bytes(xml)
+        self._rels = RelationshipList()
+
+    def cleanup(self) -> None:
+        os.remove(self.out)
+        ALL_TEMP_FILES.remove(self.out)
+
+
+class PrewrittenSheet(WriteOnlyWorksheet):
+    """A write-only sheet whose XML (from take_sheet_xml()) is saved as it is"""
+
+    def __init__(self, parent: Workbook, title: str, xml: bytes):
+        super().__init__(parent, title)
+        self._writer = _PrewrittenSheetWriter(xml)
+
+    @property
+    def closed(self) -> bool:
+        return True
+
+
+def add_sheet(workbook: Workbook, ws: WriteOnlyWorksheet) -> None:
+    """Appends a sheet that was created outside workbook.create_sheet()"""
+    workbook._add_sheet(ws)
+
+
+def cell_style(cell: Union[Cell, MergedCell, WriteOnlyCell]) -> StyleArray:
+    """The style indexes openpyxl resolved for cell's named style, font etc."""
+    return cell._style
+
+
+def set_cell_style(
+    cell: Union[Cell, MergedCell, WriteOnlyCell], style: StyleArray
+) -> None:
+    """Gives cell a copy of style (from cell_style()) without resolving it again"""
+    cell._style = copy(style)
+
+
+def register_cell_style(workbook: Workbook, style: StyleArray) -> None:
+    """Gives style the next style id in workbook, unless it already has one"""
+    workbook._cell_styles.add(style)
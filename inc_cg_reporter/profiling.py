@@ -0,0 +1,152 @@
+import cProfile
+import pathlib
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from types import FrameType
+from typing import Collection, Iterator, Optional
+
+import daiquiri
+
+logger = daiquiri.getLogger(__name__)
+
+
+class PhaseProfiler:
+    """Profiles phases of a run, writing what it finds to directory
+
+    Modes, any of which can be combined:
+
+    cprofile: <phase>.prof, for pstats or snakeviz. Only the thread running
+      the phase is profiled, not its worker threads or processes.
+    tracemalloc: <phase>.allocations.txt, the top lines by memory allocated
+      (and still held) during the phase, and the phase's peak. Slows a run
+      several times over.
+    sample: <phase>.folded, stacks of every thread sampled each
+      sample_interval seconds, in the collapsed format flamegraph.pl and
+      speedscope read. Cheap enough to leave on for scheduled runs.
+
+    Only phases named in phases are profiled, or all of them if it's empty.
+    """
+
+    CPROFILE = "cprofile"
+    TRACEMALLOC = "tracemalloc"
+    SAMPLE = "sample"
+    MODES = (CPROFILE, TRACEMALLOC, SAMPLE)
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        modes: Collection[str] = (CPROFILE,),
+        phases: Collection[str] = (),
+        top: int = 25,
+        sample_interval: float = 0.05,
+    ):
+        if unknown := set(modes) - set(self.MODES):
+            raise ValueError(f"Unknown profiling modes: {', '.join(sorted(unknown))}")
+        directory.mkdir(parents=True, exist_ok=True)
+        self._directory = directory
+        self._modes = modes
+        self._phases = set(phases)
+        self._top = top
+        self._sample_interval = sample_interval
+
+    @contextmanager
+    def profile(self, phase: str) -> Iterator[None]:
+        if self._phases and phase not in self._phases:
+            yield
+            return
+        with ExitStack() as stack:
+            # Entered in this order so that tracemalloc's overhead isn't
+            #  included in the cProfile results
+            if self.SAMPLE in self._modes:
+                stack.enter_context(self._sample(phase))
+            if self.TRACEMALLOC in self._modes:
+                stack.enter_context(self._trace_allocations(phase))
+            if self.CPROFILE in self._modes:
+                stack.enter_context(self._cprofile(phase))
+            yield
+
+    @contextmanager
+    def _cprofile(self, phase: str) -> Iterator[None]:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            path = self._directory / f"{phase}.prof"
+            profile.dump_stats(path)
+            logger.info("Profile of %s written to %s", phase, path)
+
+    @contextmanager
+    def _trace_allocations(self, phase: str) -> Iterator[None]:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if started:
+                tracemalloc.stop()
+            ignore = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+            stats = after.filter_traces(ignore).compare_to(
+                before.filter_traces(ignore), "lineno"
+            )
+            path = self._directory / f"{phase}.allocations.txt"
+            with path.open("w") as f:
+                f.write(f"Peak traced memory during {phase}: {peak / 1024:.1f} KiB\n")
+                f.write(f"Top {self._top} lines by memory allocated:\n")
+                for stat in stats[: self._top]:
+                    f.write(f"{stat}\n")
+            logger.info("Allocations of %s written to %s", phase, path)
+
+    @contextmanager
+    def _sample(self, phase: str) -> Iterator[None]:
+        stacks: Counter = Counter()
+        stop = threading.Event()
+
+        def sample() -> None:
+            own = threading.get_ident()
+            while not stop.wait(self._sample_interval):
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    current: Optional[FrameType] = frame
+                    while current is not None:
+                        code = current.f_code
+                        stack.append(
+                            f"{code.co_name} ({pathlib.Path(code.co_filename).name}"
+                            f":{code.co_firstlineno})"
+                        )
+                        current = current.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    stacks[";".join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=sample, name="phase-sampler", daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            path = self._directory / f"{phase}.folded"
+            with path.open("w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info(
+                "%d stack samples of %s written to %s",
+                sum(stacks.values()),
+                phase,
+                path,
+            )
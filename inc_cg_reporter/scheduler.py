@@ -0,0 +1,204 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import daiquiri
+import pypco
+import requests
+
+logger = daiquiri.getLogger(__name__)
+
+
+class RequestScheduler:
+    """Rate limit aware stand-in for a PCO client's requests.Session
+
+    Installed on a PCO instance, every request that client makes (field
+    definitions, field data pages, name lookups) goes through one scheduler:
+
+    - a token bucket sized to PCO's documented limit of 100 requests per 20
+      seconds (adjusted if PCO's X-PCO-API-Request-Rate-* headers disagree)
+    - a 429 pauses every request until Retry-After has passed, and is then
+      retried here, so pypco never sees it
+    - concurrency is halved on a 429 and grows by one after every
+      ramp_up_after requests in a row that weren't rate limited
+    - when requests are waiting, the lowest priority number goes first
+      (oldest first within a priority), so name lookups queued behind a
+      field data scan can't hold it up
+    """
+
+    DEFAULT_RATE_LIMIT = 100
+    DEFAULT_RATE_PERIOD_SECONDS = 20
+    DEFAULT_MAX_CONCURRENCY = 8
+    DEFAULT_RAMP_UP_AFTER = 20
+    # (url path prefix, priority); lower numbers are sent first
+    DEFAULT_PRIORITIES: Sequence[Tuple[str, int]] = (
+        ("/people/v2/field_definitions", 0),
+        ("/people/v2/field_data", 0),
+        ("/people/v2/people", 1),
+    )
+    DEFAULT_PRIORITY = 1
+
+    def __init__(
+        self,
+        session: requests.Session,
+        rate_limit: int = DEFAULT_RATE_LIMIT,
+        rate_period_seconds: float = DEFAULT_RATE_PERIOD_SECONDS,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        ramp_up_after: int = DEFAULT_RAMP_UP_AFTER,
+        priorities: Sequence[Tuple[str, int]] = DEFAULT_PRIORITIES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._session = session
+        self._priorities = priorities
+        self._max_concurrency = max_concurrency
+        self._ramp_up_after = ramp_up_after
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._set_rate(rate_limit, rate_period_seconds)
+        self._tokens = float(rate_limit)
+        self._refilled_at = clock()
+        self._paused_until = 0.0
+        self._concurrency = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        # heap of (priority, arrival order) for requests waiting to be sent
+        self._waiting: List[Tuple[int, int]] = []
+        self._arrivals = itertools.count()
+        self.requests_sent = 0
+        self.rate_limited = 0
+        # Responses handed back to pypco (each one a page of some list, for
+        #  the requests the reporter makes), and the size of the bodies that
+        #  were downloaded for them. Bodies the HTTP cache replayed after a
+        #  304 count as pages but not bytes (see HTTPCache.bytes_saved).
+        self.pages_received = 0
+        self.bytes_received = 0
+
+    @classmethod
+    def install(cls, pco: pypco.PCO, **kwargs) -> "RequestScheduler":
+        """Routes all of pco's requests through a new scheduler"""
+        scheduler = cls(pco.session, **kwargs)
+        pco.session = scheduler
+        return scheduler
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    def _set_rate(self, rate_limit: int, rate_period_seconds: float) -> None:
+        self._capacity = float(rate_limit)
+        self._rate = rate_limit / rate_period_seconds
+
+    def priority_for(self, url: str) -> int:
+        path = urlsplit(url).path
+        for prefix, priority in self._priorities:
+            if path.startswith(prefix):
+                return priority
+        return self.DEFAULT_PRIORITY
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._refilled_at) * self._rate
+        )
+        self._refilled_at = now
+
+    def _wait_time(self, now: float) -> Optional[float]:
+        """Seconds until the next request can be sent; None if it needs a slot"""
+        if self._in_flight >= self._concurrency:
+            return None
+        if self._paused_until > now:
+            return self._paused_until - now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self._rate
+        return 0.0
+
+    def _acquire(self, priority: int) -> None:
+        with self._cond:
+            ticket = (priority, next(self._arrivals))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = self._clock()
+                    self._refill(now)
+                    wait = self._wait_time(now) if self._waiting[0] == ticket else None
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._in_flight += 1
+            self.requests_sent += 1
+            # The next request in line may be able to go too
+            self._cond.notify_all()
+
+    def _release(self, response: Optional[requests.Response]) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if response is not None and response.status_code == 429:
+                self._rate_limited(response)
+            elif response is not None:
+                self._succeeded(response)
+            self._cond.notify_all()
+
+    def _succeeded(self, response: requests.Response) -> None:
+        limit = response.headers.get("X-PCO-API-Request-Rate-Limit")
+        period = response.headers.get("X-PCO-API-Request-Rate-Period")
+        if limit and period and float(limit) != self._capacity:
+            logger.info("PCO reports a rate limit of %s per %ss", limit, period)
+            self._set_rate(int(limit), float(period))
+            self._tokens = min(self._tokens, self._capacity)
+        self._successes += 1
+        if (
+            self._successes >= self._ramp_up_after
+            and self._concurrency < self._max_concurrency
+        ):
+            self._concurrency += 1
+            self._successes = 0
+            logger.debug("Raised PCO request concurrency to %d", self._concurrency)
+
+    def _rate_limited(self, response: requests.Response) -> None:
+        retry_after = float(response.headers.get("Retry-After", 1))
+        self.rate_limited += 1
+        self._paused_until = max(self._paused_until, self._clock() + retry_after)
+        self._tokens = 0
+        self._concurrency = max(1, self._concurrency // 2)
+        self._successes = 0
+        logger.info(
+            "Rate limited by PCO; pausing for %.0fs with concurrency %d",
+            retry_after,
+            self._concurrency,
+        )
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        priority = self.priority_for(url)
+        while True:
+            self._acquire(priority)
+            response = None
+            try:
+                response = self._session.request(method, url, **kwargs)
+            finally:
+                self._release(response)
+            if response.status_code != 429:
+                with self._cond:
+                    self.pages_received += 1
+                    if not getattr(response, "from_cache", False):
+                        self.bytes_received += len(response.content)
+                return response
+
+    def close(self) -> None:
+        self._session.close()
+
+    def log_stats(self) -> None:
+        logger.info(
+            "PCO requests: %d sent, %d rate limited, final concurrency %d",
+            self.requests_sent,
+            self.rate_limited,
+            self._concurrency,
+        )
@@ -0,0 +1,50 @@
+import os
+import pathlib
+from typing import Iterable, Optional
+
+import daiquiri
+
+logger = daiquiri.getLogger(__name__)
+
+
+class SheetCache:
+    """Rendered connect group sheets kept between runs, keyed by content hash
+
+    A key identifies everything on a sheet (see
+    ConnectGroupWorksheetGenerator.content_hash()), so a cached sheet can be
+    used whenever its key comes up again without checking anything else.
+    Sheets that weren't needed by the latest workbook are pruned.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._directory = directory
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self._directory / f"{key}.xml"
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._path(key).read_bytes()
+        except OSError:
+            return None
+
+    def put(self, key: str, xml: bytes) -> None:
+        # Written under another name first, so an interrupted run can't leave
+        #  a partial sheet behind under its key
+        path = self._path(key)
+        partial = path.with_suffix(f".{os.getpid()}.partial")
+        partial.write_bytes(xml)
+        partial.replace(path)
+
+    def prune(self, keep: Iterable[str]) -> None:
+        """Removes every sheet other than those in keep"""
+        keep = set(keep)
+        removed = 0
+        for entry in self._directory.iterdir():
+            if entry.suffix == ".xml" and entry.stem in keep:
+                continue
+            entry.unlink(missing_ok=True)
+            removed += 1
+        if removed:
+            logger.info("Pruned %d sheets from %s", removed, self._directory)
@@ -0,0 +1,165 @@
+import datetime
+import pathlib
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import daiquiri
+
+logger = daiquiri.getLogger(__name__)
+
+# (field datum id, person id, value)
+FieldDatumRow = Tuple[int, int, str]
+
+
+class FieldDataSnapshot:
+    """Local SQLite copy of tracked field data and people's names
+
+    Lets a run pull only what has changed in PCO since the last successful
+    sync and rebuild the person and connect group managers from the local
+    copy. Nothing is committed until commit_sync(), so a failed run leaves
+    the previous snapshot (and its sync times) untouched.
+
+    Sync times are taken from our clock at the start of the sync, less a
+    margin to allow for clock skew and in-flight updates. Re-fetching a few
+    records that haven't changed is harmless as writes are upserts.
+    """
+
+    DEFAULT_FULL_RESYNC_INTERVAL_SECONDS = 7 * 24 * 60 * 60
+    SYNC_MARGIN = datetime.timedelta(hours=1)
+    FULL_SYNC_KEY = "full_sync"
+    NAMES_KEY = "names"
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        full_resync_interval_seconds: int = DEFAULT_FULL_RESYNC_INTERVAL_SECONDS,
+    ):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS field_data (
+                id INTEGER PRIMARY KEY,
+                field_definition_id INTEGER NOT NULL,
+                person_id INTEGER NOT NULL,
+                value TEXT
+            );
+            CREATE INDEX IF NOT EXISTS field_data_by_definition
+                ON field_data (field_definition_id);
+            CREATE TABLE IF NOT EXISTS people (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                synced_at TEXT NOT NULL
+            );
+            """)
+        self._full_resync_interval = datetime.timedelta(
+            seconds=full_resync_interval_seconds
+        )
+        self._sync_started_at: Optional[datetime.datetime] = None
+        self._synced_keys: Set[str] = set()
+
+    @staticmethod
+    def _field_data_key(field_id: int) -> str:
+        return f"field_data:{field_id}"
+
+    @staticmethod
+    def format_timestamp(ts: datetime.datetime) -> str:
+        """Formats a timestamp the way PCO's where[updated_at] filter expects"""
+        return ts.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def _synced_at(self, key: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT synced_at FROM sync_state WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def begin_sync(self, force_full: bool = False) -> bool:
+        """Starts a sync, returning True if it needs to be a full resync"""
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        self._sync_started_at = now - self.SYNC_MARGIN
+        self._synced_keys = set()
+        if force_full:
+            logger.info("Full resync requested")
+            return True
+        last_full_sync = self._synced_at(self.FULL_SYNC_KEY)
+        if last_full_sync is None:
+            logger.info("No previous full sync in snapshot; doing a full resync")
+            return True
+        last = datetime.datetime.strptime(last_full_sync, "%Y-%m-%dT%H:%M:%SZ")
+        if (
+            now - last.replace(tzinfo=datetime.timezone.utc)
+            > self._full_resync_interval
+        ):
+            logger.info("Last full sync was at %s; doing a full resync", last_full_sync)
+            return True
+        return False
+
+    def field_data_synced_at(self, field_id: int) -> Optional[str]:
+        return self._synced_at(self._field_data_key(field_id))
+
+    def names_synced_at(self) -> Optional[str]:
+        return self._synced_at(self.NAMES_KEY)
+
+    def replace_field_data(self, field_id: int, rows: Iterable[FieldDatumRow]):
+        self._conn.execute(
+            "DELETE FROM field_data WHERE field_definition_id = ?", (field_id,)
+        )
+        self.upsert_field_data(field_id, rows)
+
+    def upsert_field_data(self, field_id: int, rows: Iterable[FieldDatumRow]):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO field_data VALUES (?, ?, ?, ?)",
+            ((datum_id, field_id, pid, value) for datum_id, pid, value in rows),
+        )
+        self._synced_keys.add(self._field_data_key(field_id))
+
+    def field_data_count(self, field_id: int) -> int:
+        return int(
+            self._conn.execute(
+                "SELECT COUNT(*) FROM field_data WHERE field_definition_id = ?",
+                (field_id,),
+            ).fetchone()[0]
+        )
+
+    def field_data(self, field_id: int) -> List[Tuple[int, str]]:
+        """(person id, value) pairs for a field, in PCO's (datum id) order"""
+        return self._conn.execute(
+            "SELECT person_id, value FROM field_data"
+            " WHERE field_definition_id = ? ORDER BY id",
+            (field_id,),
+        ).fetchall()
+
+    def names(self) -> Dict[int, str]:
+        return dict(self._conn.execute("SELECT id, name FROM people").fetchall())
+
+    def store_names(self, names: Dict[int, str], replace: bool = False):
+        """Records resolved names; replace drops anyone not in names"""
+        if replace:
+            self._conn.execute("DELETE FROM people")
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO people VALUES (?, ?)", names.items()
+        )
+        self._synced_keys.add(self.NAMES_KEY)
+
+    def commit_sync(self, full: bool) -> None:
+        assert self._sync_started_at is not None, "begin_sync() was not called"
+        synced_at = self.format_timestamp(self._sync_started_at)
+        keys = self._synced_keys | ({self.FULL_SYNC_KEY} if full else set())
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+            ((key, synced_at) for key in keys),
+        )
+        self._conn.commit()
+        logger.info("Snapshot committed (%d sync times at %s)", len(keys), synced_at)
+
+    def close(self) -> None:
+        """Closes the database, discarding anything not yet committed"""
+        self._conn.close()
+
+    def __enter__(self) -> "FieldDataSnapshot":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -1,9 +1,55 @@
+import io
+import json
+import logging
+import os
+import pstats
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
 from typing import List, Any, Dict
 
+import openpyxl
+import pytest
+import pypco
+import requests
 from pretend import stub
 
-from inc_cg_reporter.connect_group import ConnectGroupMembershipManager, PersonManager
-from inc_cg_reporter.field_definition import FieldDataProcessor, PERSONAL_ATTRIBUTE_NAME
+from inc_cg_reporter.connect_group import (
+    ConnectGroupMembershipManager,
+    Person,
+    PersonManager,
+)
+from inc_cg_reporter.field_definition import (
+    FieldDataProcessor,
+    FieldDataQueryPlanner,
+    FieldDefinitionCache,
+    PlanningCentreFieldDefinitionMapper,
+    PlanningCentreFieldHandler,
+    CONNECT_GROUP_FIELD_DEFINITION_NAME,
+    PERSONAL_ATTRIBUTE_NAME,
+)
+from inc_cg_reporter.excel_writer import (
+    ConnectGroupStyles,
+    ConnectGroupWorkbookManager,
+    ConnectGroupWorksheetGenerator,
+)
+from inc_cg_reporter import app, benchmark, openpyxl_compat
+from inc_cg_reporter.delivery import SMTPPool, deliver
+from inc_cg_reporter.fake_pco import FakePCOServer, generate_organisation
+from inc_cg_reporter.fake_smtp import FakeSMTPServer
+from inc_cg_reporter.http_cache import HTTPCache
+from inc_cg_reporter.metrics import RunMetrics
+from inc_cg_reporter.name_cache import PersonNameCache
+from inc_cg_reporter.pagination import OffsetPaginator
+from inc_cg_reporter.profiling import PhaseProfiler
+from inc_cg_reporter.scheduler import RequestScheduler
+from inc_cg_reporter.sheet_cache import SheetCache
+from inc_cg_reporter.snapshot import FieldDataSnapshot
 
 
 def make_people_response(*people):
@@ -11,6 +57,95 @@ def make_people_response(*people):
     return {"data": [{"id": str(pid), "attributes": {"name": name}} for pid, name in people]}
 
 
+def make_field_datum(field_id, person_id, value, datum_id=None):
+    """Build a minimal pypco.iterate() record for a single PCO FieldDatum."""
+    return {
+        "data": {
+            "id": str(datum_id),
+            "attributes": {"value": value},
+            "relationships": {
+                "field_definition": {"data": {"id": str(field_id)}},
+                "customizable": {"data": {"id": str(person_id)}},
+            },
+        }
+    }
+
+
+def make_field_data_pco(field_data):
+    """Stub PCO whose iterate() serves field_data = {field_id: [(person_id, value)]}"""
+
+    def filtered_iterate(*args, **kwargs):
+        field_id = kwargs.get("where[field_definition_id]")
+        return [make_field_datum(field_id, *pv) for pv in field_data.get(field_id, [])]
+
+    return stub(iterate=filtered_iterate)
+
+
+def process_with_workers(
+    field_definition_mapper, pco, max_workers, bulk=False, **kwargs
+):
+    pm = PersonManager()
+    cgm = ConnectGroupMembershipManager(pm)
+    handler = PlanningCentreFieldHandler(field_definition_mapper)
+    handler.register_method(
+        CONNECT_GROUP_FIELD_DEFINITION_NAME,
+        cgm.add,
+        cgm.add_members_bulk if bulk else None,
+    )
+    handler.register_method(
+        "Decision Date", pm.add_attribute, pm.add_attributes_bulk if bulk else None
+    )
+    handler.register_method(
+        "Water Baptism Date",
+        pm.add_or_extend_attribute,
+        pm.add_or_extend_attributes_bulk if bulk else None,
+    )
+    # noinspection PyTypeChecker
+    fdp = FieldDataProcessor(
+        pco, "dummy", [], [], pm, cgm, max_workers=max_workers, **kwargs
+    )
+    fdp.process_field_data(handler)
+    return pm, cgm
+
+
+class FakeFieldDataPCO:
+    """Serves field data = {datum_id: (field_id, person_id, value, updated_at)}
+
+    Honours where[field_definition_id] (optionally including comma separated
+    lists) and where[updated_at][gte], and records every request made.
+    """
+
+    def __init__(self, field_data, honours_id_lists=True):
+        self.field_data = field_data
+        self.honours_id_lists = honours_id_lists
+        self.calls: List[Any] = []
+
+    def _matching(self, params):
+        field_filter = str(params.get("where[field_definition_id]", ""))
+        if "," in field_filter and not self.honours_id_lists:
+            field_filter = ""
+        field_ids = {int(f) for f in field_filter.split(",") if f}
+        since = params.get("where[updated_at][gte]", "")
+        return [
+            make_field_datum(f, p, v, datum_id)
+            for datum_id, (f, p, v, updated_at) in sorted(self.field_data.items())
+            if (not field_ids or f in field_ids) and updated_at >= since
+        ]
+
+    def iterate(self, url, **params):
+        self.calls.append(("iterate", params))
+        return self._matching(params)
+
+    def get(self, url, per_page=25, offset=0, **params):
+        self.calls.append(("get", params))
+        matching = self._matching(params)
+        return {
+            "data": [d["data"] for d in matching[offset : offset + per_page]],
+            "links": {"next": "..."} if offset + per_page < len(matching) else {},
+            "meta": {"total_count": len(matching)},
+        }
+
+
 def test_cg_extraction_from_field_data(
     pco_field_data_with_cell_group,
     field_dispatcher,
@@ -54,6 +189,254 @@ def test_person_attribute_extraction_from_field_data(
     assert connect_group_person_manager.connect_groups == {}
 
 
+def test_concurrent_field_fetch_matches_sequential(field_definition_mapper):
+    pco = make_field_data_pco(
+        {
+            401410: [(1, "Alpha CG"), (2, "Beta CG"), (3, "Alpha CG")],
+            88096: [(1, "01/01/2020"), (2, "02/02/2020")],
+            # Multi-value handler, so the order of dispatch is visible
+            87410: [(1, "a"), (1, "b"), (3, "c"), (1, "d")],
+        }
+    )
+    seq_pm, seq_cgm = process_with_workers(field_definition_mapper, pco, 1)
+    par_pm, par_cgm = process_with_workers(field_definition_mapper, pco, 4)
+
+    assert par_pm._people == seq_pm._people
+    assert par_cgm.connect_groups == seq_cgm.connect_groups
+    assert list(par_cgm.connect_groups) == list(seq_cgm.connect_groups)
+    baptism_dates = par_pm._people[1].personal_attributes["Water Baptism Date"]
+    assert baptism_dates == ["a", "b", "d"]
+
+
+def make_paged_pco(records, total_count=None):
+    """Stub PCO whose get() pages through records by offset, like the real API.
+
+    total_count lets a test report a stale count, as when records are added
+    between the count probe and the page fetches.
+    """
+
+    def paged_get(url, per_page=25, offset=0, **params):
+        # Later pages return first, so any ordering bug shows up
+        time.sleep(0.001 * max(0, 5 - offset // per_page))
+        page = records[offset : offset + per_page]
+        links = {"next": "..."} if offset + per_page < len(records) else {}
+        count = len(records) if total_count is None else total_count
+        return {"data": page, "links": links, "meta": {"total_count": count}}
+
+    return stub(get=paged_get)
+
+
+def test_offset_paginator_preserves_record_order():
+    records = [{"id": str(i)} for i in range(523)]
+    paginator = OffsetPaginator(make_paged_pco(records), max_workers=4, per_page=50)
+    assert [r["data"] for r in paginator.iterate("/people/v2/field_data")] == records
+
+
+def test_offset_paginator_follows_links_past_stale_total_count():
+    records = [{"id": str(i)} for i in range(120)]
+    pco = make_paged_pco(records, total_count=60)
+    paginator = OffsetPaginator(pco, max_workers=4, per_page=25)
+    assert [r["data"] for r in paginator.iterate("/people/v2/field_data")] == records
+
+
+def make_field_definitions_pco(definitions, calls):
+    """Stub PCO serving field definitions = {id: name}, recording requests."""
+
+    def as_data(items):
+        return [{"id": str(i), "attributes": {"name": n}} for i, n in items]
+
+    def get(url, **params):
+        calls.append(("get", params))
+        if "where[id]" in params:
+            ids = {int(i) for i in params["where[id]"].split(",")}
+            return {"data": as_data((i, n) for i, n in definitions.items() if i in ids)}
+        return {"data": [], "meta": {"total_count": len(definitions)}}
+
+    def iterate(url, **params):
+        calls.append(("iterate", params))
+        return [{"data": d} for d in as_data(definitions.items())]
+
+    return stub(get=get, iterate=iterate)
+
+
+def test_field_definition_cache_miss_then_hit(tmp_path):
+    cache = FieldDefinitionCache(tmp_path / "field_definitions.json")
+    definitions = {1: "Unrelated", 401410: "Connect Group", 87410: "Team "}
+    calls: List[Any] = []
+    pco = make_field_definitions_pco(definitions, calls)
+
+    mapper = PlanningCentreFieldDefinitionMapper(pco, ["Connect Group", "Team"], cache)
+    assert mapper.build_map() is False
+    assert ("iterate", {"per_page": 100}) in calls
+
+    calls.clear()
+    mapper = PlanningCentreFieldDefinitionMapper(pco, ["Connect Group", "Team"], cache)
+    assert mapper.build_map() is True
+    assert len(calls) == 1 and calls[0][1]["where[id]"] == "87410,401410"
+    assert mapper.field_defs_name_by_id == {401410: "Connect Group", 87410: "Team"}
+
+
+def test_field_definition_cache_mismatch_falls_back_to_scan(tmp_path):
+    cache = FieldDefinitionCache(tmp_path / "field_definitions.json")
+    cache.store({"Connect Group": 1})
+    calls: List[Any] = []
+    pco = make_field_definitions_pco({1: "Renamed", 2: "Connect Group"}, calls)
+
+    mapper = PlanningCentreFieldDefinitionMapper(pco, ["Connect Group"], cache)
+    assert mapper.build_map() is False
+    assert mapper.field_defs_id_by_name == {"Connect Group": 2}
+    assert cache.load() == {"Connect Group": 2}
+
+
+def test_field_definition_cache_expires(tmp_path):
+    cache = FieldDefinitionCache(tmp_path / "field_definitions.json", ttl_seconds=-1)
+    cache.store({"Connect Group": 1})
+    assert cache.load() is None
+
+
+def test_incremental_snapshot_sync_matches_full_fetch(
+    tmp_path, field_definition_mapper
+):
+    pco = FakeFieldDataPCO(
+        {
+            1: (401410, 1, "Alpha CG", "2020-01-01T00:00:00Z"),
+            2: (401410, 2, "Alpha CG", "2020-01-01T00:00:00Z"),
+            3: (87410, 1, "a", "2020-01-01T00:00:00Z"),
+            4: (88096, 2, "01/01/2020", "2020-01-01T00:00:00Z"),
+        }
+    )
+    with FieldDataSnapshot(tmp_path / "snapshot.sqlite3") as snapshot:
+        assert snapshot.begin_sync() is True
+        process_with_workers(field_definition_mapper, pco, 2, snapshot=snapshot)
+        snapshot.commit_sync(full=True)
+    with pytest.raises(sqlite3.ProgrammingError):
+        snapshot.names()
+
+    # Person 2 moves group, person 1 gains a value, the date datum is deleted
+    pco.field_data[2] = (401410, 2, "Beta CG", "2030-01-01T00:00:00Z")
+    pco.field_data[5] = (87410, 1, "b", "2030-01-01T00:00:00Z")
+    del pco.field_data[4]
+    pco.calls.clear()
+    snapshot = FieldDataSnapshot(tmp_path / "snapshot.sqlite3")
+    assert snapshot.begin_sync() is False
+    inc_pm, inc_cgm = process_with_workers(
+        field_definition_mapper, pco, 2, snapshot=snapshot, full_resync=False
+    )
+    # Only the field that lost a datum needed an unfiltered rescan
+    rescans = [
+        params["where[field_definition_id]"]
+        for method, params in pco.calls
+        if method == "iterate" and "where[updated_at][gte]" not in params
+    ]
+    assert rescans == [88096]
+
+    full_pm, full_cgm = process_with_workers(field_definition_mapper, pco, 1)
+    assert inc_pm._people == full_pm._people
+    assert inc_cgm.connect_groups == full_cgm.connect_groups
+    assert inc_pm._people[1].personal_attributes["Water Baptism Date"] == ["a", "b"]
+    snapshot.close()
+
+
+def make_untracked_field_data():
+    # Mostly data for fields we don't track, with a tracked field that spans
+    #  several pages, so per-field and batched plans differ in cost.
+    field_data = {i: (999, i, "x", "") for i in range(1, 1001)}
+    field_data.update({2000 + i: (401410, i, f"CG {i % 3}", "") for i in range(250)})
+    field_data.update({3000 + i: (87410, i % 5, str(i), "") for i in range(30)})
+    field_data[4000] = (88096, 1, "01/01/2020", "")
+    return field_data
+
+
+def test_query_planner_prefers_batched_query_when_honoured():
+    pco = FakeFieldDataPCO(make_untracked_field_data())
+    planner = FieldDataQueryPlanner(pco)
+    field_ids = [401410, 87410, 88096]
+    assert planner.estimate_costs(field_ids) == {
+        "per_field": 5,
+        "batched": 3,
+        "unfiltered": 13,
+    }
+    assert planner.choose(field_ids) == FieldDataQueryPlanner.BATCHED
+
+
+def test_query_planner_skips_batched_query_when_ignored():
+    pco = FakeFieldDataPCO(make_untracked_field_data(), honours_id_lists=False)
+    planner = FieldDataQueryPlanner(pco)
+    costs = planner.estimate_costs([401410, 87410, 88096])
+    assert "batched" not in costs
+    assert planner.choose([401410, 87410, 88096]) == FieldDataQueryPlanner.PER_FIELD
+
+
+@pytest.mark.parametrize("plan", ["batched", "unfiltered", "auto"])
+def test_query_plans_produce_same_state(field_definition_mapper, plan):
+    pco = FakeFieldDataPCO(make_untracked_field_data())
+    per_field_pm, per_field_cgm = process_with_workers(field_definition_mapper, pco, 1)
+    plan_pm, plan_cgm = process_with_workers(field_definition_mapper, pco, 1, plan=plan)
+    assert plan_pm._people == per_field_pm._people
+    assert list(plan_pm._people) == list(per_field_pm._people)
+    assert plan_cgm.connect_groups == per_field_cgm.connect_groups
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"plan": "per_field"},
+        {"plan": "per_field", "page_workers": 3},
+        {"plan": "batched"},
+    ],
+)
+def test_lean_field_data_decoding_produces_same_state(field_definition_mapper, kwargs):
+    pco = FakeFieldDataPCO(make_untracked_field_data())
+    expected_pm, expected_cgm = process_with_workers(field_definition_mapper, pco, 1)
+    pco.calls.clear()
+    lean_pm, lean_cgm = process_with_workers(
+        field_definition_mapper, pco, 2, lean=True, **kwargs
+    )
+    assert lean_pm._people == expected_pm._people
+    assert lean_cgm.connect_groups == expected_cgm.connect_groups
+    assert all(
+        params["fields[FieldDatum]"] == "value,customizable,field_definition"
+        for method, params in pco.calls
+    )
+
+
+@pytest.mark.parametrize("log_level", [logging.INFO, logging.DEBUG])
+def test_bulk_dispatch_matches_per_record_dispatch(
+    field_definition_mapper, caplog, log_level
+):
+    caplog.set_level(log_level, logger="inc_cg_reporter.connect_group")
+    pco = FakeFieldDataPCO(make_untracked_field_data())
+    expected_pm, expected_cgm = process_with_workers(field_definition_mapper, pco, 1)
+    bulk_pm, bulk_cgm = process_with_workers(field_definition_mapper, pco, 1, bulk=True)
+    assert bulk_pm._people == expected_pm._people
+    assert bulk_cgm.connect_groups == expected_cgm.connect_groups
+    team = bulk_pm._people[1].personal_attributes["Water Baptism Date"]
+    assert team == ["1", "6", "11", "16", "21", "26"]
+
+
+def test_dispatch_batch_ignores_unmapped_field(field_dispatcher, person_manager):
+    field_dispatcher.dispatch_batch(999, [(1, "value")])
+    assert person_manager._people == {}
+
+
+def test_populate_names_uses_known_names(person_manager, connect_group_person_manager):
+    connect_group_person_manager.add("", "Alpha CG", 111)
+    connect_group_person_manager.add("", "Alpha CG", 222)
+
+    calls = []
+
+    def tracking_get(*args, **kwargs):
+        calls.append(kwargs)
+        return make_people_response((222, "Bob"))
+
+    connect_group_person_manager.populate_names_for_people(
+        stub(get=tracking_get), known_names={111: "Alice"}
+    )
+
+    assert [c["where[id]"] for c in calls] == ["222"]
+    assert connect_group_person_manager.member_names == {111: "Alice", 222: "Bob"}
+
+
 def test_get_person_name_from_id(person_data: Dict[str, str]):
     pco = stub(get=lambda *args, **kwargs: person_data)
     assert (
@@ -130,6 +513,435 @@ def test_populate_names_deduplicates_across_connect_groups(
     assert person_manager._people[111].personal_attributes[PERSONAL_ATTRIBUTE_NAME] == "Alice"
 
 
+def make_people_pco(names, calls, updated=()):
+    """Stub PCO resolving where[id] lookups against names = {id: name}, and
+    listing updated = [(id, name, updated_at)] as people updated since."""
+
+    def get(url, **params):
+        ids = [int(i) for i in str(params["where[id]"]).split(",")]
+        calls.append(ids)
+        return make_people_response(*((i, names[i]) for i in ids if i in names))
+
+    def iterate(url, **params):
+        calls.append(params["where[updated_at][gte]"])
+        for pid, name, updated_at in updated:
+            attributes = {"name": name, "updated_at": updated_at}
+            yield {"data": {"id": str(pid), "attributes": attributes}}
+
+    return stub(get=get, iterate=iterate)
+
+
+def test_populate_names_concurrently(person_manager, connect_group_person_manager):
+    names = {pid: f"Person {pid}" for pid in range(1, 451)}
+    connect_group_person_manager.add_members_bulk(
+        "", [(pid, f"CG {pid % 7}") for pid in range(1, 452)]
+    )
+    calls: List[Any] = []
+    connect_group_person_manager.populate_names_for_people(
+        make_people_pco(names, calls), max_workers=3
+    )
+    assert len(calls) == 5
+    assert connect_group_person_manager.member_names == names
+    # 451 has no PCO record
+    assert connect_group_person_manager.groups_for_person(451) == []
+
+
+def test_populate_names_uses_and_maintains_name_cache(
+    tmp_path, person_manager, connect_group_person_manager
+):
+    cache = PersonNameCache(tmp_path / "names.json")
+    cache.put(1, "Cached Alice")
+    cache.put(3, "Deleted Carol")
+    cache.save()
+    cache = PersonNameCache(tmp_path / "names.json", ttl_seconds=60)
+    for pid in (1, 2, 3):
+        connect_group_person_manager.add("", "Alpha CG", pid)
+    # Carol's cache entry has "expired", so PCO is asked and reports her gone
+    cache._entries[3] = ("Deleted Carol", None, 0.0)
+
+    calls: List[Any] = []
+    pco = make_people_pco({1: "Alice", 2: "Bob"}, calls)
+    connect_group_person_manager.populate_names_for_people(pco, name_cache=cache)
+
+    # Nobody was updated since the previous run, so Alice's cached name stands
+    assert calls[0] == cache.refreshed_at
+    assert sorted(calls[1]) == [2, 3]
+    assert connect_group_person_manager.member_names == {1: "Cached Alice", 2: "Bob"}
+    assert cache.get(2) == "Bob"
+    assert cache.get(3) is None and len(cache) == 2
+    get_name = ConnectGroupMembershipManager.get_person_name_from_id
+    assert get_name(pco, 2, cache) == "Bob"
+    assert len(calls) == 2
+
+
+def test_populate_names_refreshes_renamed_people_in_name_cache(
+    tmp_path, person_manager, connect_group_person_manager
+):
+    cache = PersonNameCache(tmp_path / "names.json")
+    cache.put(1, "Alice", "2020-09-21T06:58:23Z")
+    cache.put(2, "Bob", "2020-09-21T06:58:23Z")
+    cache.save()
+    cache = PersonNameCache(tmp_path / "names.json")
+    for pid in (1, 2):
+        connect_group_person_manager.add("", "Alpha CG", pid)
+
+    calls: List[Any] = []
+    updated = [
+        (1, "Alicia", "2020-09-22T08:00:00Z"),
+        # Older than what's cached, e.g. a page listed before Bob's last fetch
+        (2, "Robert", "2020-09-20T08:00:00Z"),
+        # Not cached, so left for the usual lookup
+        (3, "Carol", "2020-09-22T08:00:00Z"),
+    ]
+    pco = make_people_pco({}, calls, updated)
+    connect_group_person_manager.populate_names_for_people(pco, name_cache=cache)
+
+    assert len(calls) == 1
+    assert connect_group_person_manager.member_names == {1: "Alicia", 2: "Bob"}
+    assert cache.get(3) is None
+
+
+def test_person_name_cache_evicts_least_recently_used(tmp_path):
+    cache = PersonNameCache(tmp_path / "names.json", max_entries=2)
+    cache.put(1, "Alice")
+    cache.put(2, "Bob")
+    cache.put(3, "Carol")
+    cache.get(1)
+    cache.save()
+    reloaded = PersonNameCache(tmp_path / "names.json")
+    assert (reloaded.get(1), reloaded.get(2), reloaded.get(3)) == (
+        "Alice",
+        None,
+        "Carol",
+    )
+
+
+# ---------------------------------------------------------------------------
+# RequestScheduler
+# ---------------------------------------------------------------------------
+
+
+class FakePCOSession:
+    """Stands in for PCO's requests.Session, answering 429 to the first
+    `throttle` requests and blocking each request until `gate` is set"""
+
+    def __init__(self, throttle=0):
+        self.throttle = throttle
+        self.gate = threading.Event()
+        self.gate.set()
+        self.paths: List[str] = []
+
+    def request(self, method, url, **kwargs):
+        self.gate.wait()
+        self.paths.append(url.split("planningcenteronline.com", 1)[-1])
+        response = requests.Response()
+        if self.throttle:
+            self.throttle -= 1
+            response.status_code = 429
+            response.headers["Retry-After"] = "0"
+        else:
+            response.status_code = 200
+            response._content = json.dumps({"data": [], "meta": {}}).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+def make_scheduled_pco(session, **kwargs):
+    pco = pypco.PCO("app-id", "secret")
+    pco.session = session
+    return pco, RequestScheduler.install(pco, rate_limit=1000, **kwargs)
+
+
+def test_scheduler_retries_rate_limited_requests_and_backs_off():
+    session = FakePCOSession(throttle=2)
+    pco, scheduler = make_scheduled_pco(session, max_concurrency=8, ramp_up_after=2)
+    assert pco.get("/people/v2/field_data") == {"data": [], "meta": {}}
+    assert len(session.paths) == 3
+    assert (scheduler.rate_limited, scheduler.concurrency) == (2, 2)
+    for _ in range(4):
+        pco.get("/people/v2/field_data")
+    assert scheduler.concurrency == 4
+
+
+def test_scheduler_sends_field_data_ahead_of_waiting_name_lookups():
+    session = FakePCOSession()
+    pco, scheduler = make_scheduled_pco(session, max_concurrency=1)
+    session.gate.clear()
+    threads = [
+        threading.Thread(target=pco.get, args=(path,))
+        for path in (
+            "/people/v2/field_data",
+            "/people/v2/people",
+            "/people/v2/field_data",
+        )
+    ]
+    for queued, thread in enumerate(threads, start=1):
+        thread.start()
+        # Let each request take its place in the queue before the next
+        while len(scheduler._waiting) + scheduler._in_flight < queued:
+            time.sleep(0.001)
+    session.gate.set()
+    for thread in threads:
+        thread.join()
+    assert session.paths == [
+        "/people/v2/field_data",
+        "/people/v2/field_data",
+        "/people/v2/people",
+    ]
+
+
+def test_scheduler_token_bucket_limits_request_rate():
+    session = FakePCOSession()
+    pco = pypco.PCO("app-id", "secret")
+    pco.session = session
+    RequestScheduler.install(pco, rate_limit=2, rate_period_seconds=0.1)
+    start = time.monotonic()
+    for _ in range(4):
+        pco.get("/people/v2/people")
+    # Two requests were in the bucket; the other two wait 0.05s each
+    assert time.monotonic() - start >= 0.09
+
+
+# ---------------------------------------------------------------------------
+# HTTPCache
+# ---------------------------------------------------------------------------
+
+
+class FakeETagSession:
+    """Serves bodies = {path: body} with ETags, answering 304 to a match"""
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.statuses: List[int] = []
+
+    def request(self, method, url, headers=None, params=None, **kwargs):
+        body = json.dumps(self.bodies[url.split("planningcenteronline.com")[-1]])
+        etag = f'"{hash(body)}"'
+        response = requests.Response()
+        response.headers["ETag"] = etag
+        if (headers or {}).get("If-None-Match") == etag:
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            response._content = body.encode()
+        self.statuses.append(response.status_code)
+        return response
+
+    def close(self):
+        pass
+
+
+def make_cached_pco(session, directory, **kwargs):
+    pco = pypco.PCO("app-id", "secret")
+    pco.session = session
+    http_cache = HTTPCache(directory, **kwargs)
+    http_cache.install(pco)
+    return pco, http_cache
+
+
+def test_http_cache_serves_not_modified_responses_from_disk(tmp_path):
+    session = FakeETagSession({"/people/v2/field_definitions": {"data": [1]}})
+    pco, http_cache = make_cached_pco(session, tmp_path)
+    assert pco.get("/people/v2/field_definitions") == {"data": [1]}
+    # A new run, with the cache reloaded from disk
+    pco, http_cache = make_cached_pco(session, tmp_path)
+    assert pco.get("/people/v2/field_definitions") == {"data": [1]}
+    session.bodies["/people/v2/field_definitions"] = {"data": [1, 2]}
+    assert pco.get("/people/v2/field_definitions") == {"data": [1, 2]}
+    assert pco.get("/people/v2/field_definitions") == {"data": [1, 2]}
+    assert session.statuses == [200, 304, 200, 304]
+    assert (http_cache.hits, http_cache.misses) == (2, 1)
+    assert http_cache.bytes_saved == len('{"data": [1]}') + len('{"data": [1, 2]}')
+
+
+def test_scheduler_counts_only_downloaded_bytes_under_http_cache(tmp_path):
+    session = FakeETagSession({"/people/v2/field_definitions": {"data": [1]}})
+    pco, http_cache = make_cached_pco(session, tmp_path)
+    scheduler = RequestScheduler.install(pco)
+    for _ in range(3):
+        pco.get("/people/v2/field_definitions")
+    assert session.statuses == [200, 304, 304]
+    assert scheduler.pages_received == 3
+    assert scheduler.bytes_received == len('{"data": [1]}')
+    assert http_cache.bytes_saved == 2 * len('{"data": [1]}')
+
+
+def test_http_cache_evicts_least_recently_used(tmp_path):
+    bodies = {f"/people/v2/people/{i}": {"data": "x" * 100} for i in range(3)}
+    session = FakeETagSession(bodies)
+    pco, http_cache = make_cached_pco(session, tmp_path, max_bytes=400)
+    for i in (0, 1, 0, 2, 0, 1):
+        pco.get(f"/people/v2/people/{i}")
+    # Only two ~150 byte entries fit, so 1 was evicted when 2 was stored
+    assert session.statuses == [200, 200, 304, 200, 304, 200]
+    assert len(list(tmp_path.glob("*.json"))) == 2
+
+
+# ---------------------------------------------------------------------------
+# Fake PCO server
+# ---------------------------------------------------------------------------
+
+
+def test_fake_pco_paginates_filters_and_throttles():
+    organisation = generate_organisation(people=200, connect_groups=5, seed=1)
+    with FakePCOServer(organisation, throttle_every=5, retry_after=0) as server:
+        pco = pypco.PCO("app-id", "secret", api_base=server.api_base)
+        RequestScheduler.install(pco, rate_limit=1000)
+        people = list(pco.iterate("/people/v2/people", per_page=30))
+        assert len(people) == 200
+        page = pco.get("/people/v2/people", **{"where[id]": "2000003,2000007"})
+        assert page["meta"]["total_count"] == 2
+        assert [p["id"] for p in page["data"]] == ["2000003", "2000007"]
+        assert server.throttled > 0
+        with pytest.raises(pypco.exceptions.PCORequestException):
+            pco.get("/people/v2/people", **{"where[nickname]": "Sam"})
+    for query in ("per_page=ten", "offset=1.5", "per_page=0", "offset=-25"):
+        status, body = server.respond("/people/v2/people", query)
+        assert status == 400, query
+        assert body["errors"][0]["status"] == "400"
+
+
+def test_app_runs_against_fake_pco(tmp_path, monkeypatch):
+    organisation = generate_organisation(people=300, connect_groups=8, seed=2)
+    expected_groups = {
+        datum["attributes"]["value"]
+        for datum, _ in organisation.field_data
+        if datum["relationships"]["field_definition"]["data"]["id"]
+        == next(
+            definition["id"]
+            for definition, _ in organisation.field_definitions
+            if definition["attributes"]["name"] == CONNECT_GROUP_FIELD_DEFINITION_NAME
+        )
+    }
+    with FakePCOServer(organisation) as server:
+        monkeypatch.setenv("OUTPUT_FILE", str(tmp_path / "inc_cg.xlsx"))
+        monkeypatch.setenv("RUN_REPORT_FILE", str(tmp_path / "run.json"))
+        monkeypatch.setenv("PROMETHEUS_TEXTFILE", str(tmp_path / "run.prom"))
+        monkeypatch.setenv("PCO_API_BASE", server.api_base)
+        monkeypatch.setenv("PC_APPLICATION_ID", "app-id")
+        monkeypatch.setenv("PC_SECRET", "secret")
+        monkeypatch.setenv("SEND_EMAIL", "false")
+        monkeypatch.delenv("CACHE_DIR", raising=False)
+        app.run()
+    workbook = openpyxl.load_workbook(tmp_path / "inc_cg.xlsx")
+    assert set(workbook.sheetnames) == expected_groups | {"About"}
+    report = json.loads((tmp_path / "run.json").read_text())
+    assert report["succeeded"]
+    assert list(report["phases"]) == [
+        "field_definition_mapping",
+        "field_data_processing",
+        "name_population",
+        "workbook_create",
+        "workbook_save",
+    ]
+    assert report["counters"]["connect_groups"] == len(expected_groups)
+    assert report["counters"]["pco_requests"] == report["counters"]["pco_pages"]
+    assert 0 < report["counters"]["names_fetched"] <= 300
+    prom = (tmp_path / "run.prom").read_text()
+    assert "inc_cg_reporter_last_run_success 1\n" in prom
+    assert 'inc_cg_reporter_phase_seconds{phase="workbook_create"}' in prom
+
+
+def test_run_metrics_reported_for_failed_runs(tmp_path):
+    metrics = RunMetrics()
+    with pytest.raises(RuntimeError):
+        with metrics.phase("field_data_processing"):
+            raise RuntimeError("PCO is down")
+    metrics.record(pco_requests=3)
+    metrics.write_json(tmp_path / "run.json")
+    metrics.write_prometheus(tmp_path / "run.prom")
+    report = json.loads((tmp_path / "run.json").read_text())
+    assert not report["succeeded"]
+    assert report["phases"]["field_data_processing"]["seconds"] >= 0
+    assert report["counters"] == {"pco_requests": 3}
+    prom = (tmp_path / "run.prom").read_text()
+    assert "inc_cg_reporter_last_run_success 0\n" in prom
+    assert "inc_cg_reporter_pco_requests 3\n" in prom
+    # No partially written files are left behind
+    assert {p.name for p in tmp_path.iterdir()} == {"run.json", "run.prom"}
+
+
+def test_profiler_writes_results_for_chosen_phases(tmp_path):
+    profiler = PhaseProfiler(
+        tmp_path,
+        modes=PhaseProfiler.MODES,
+        phases=["workbook_create"],
+        sample_interval=0.001,
+    )
+    metrics = RunMetrics(profiler)
+    with metrics.phase("field_data_processing"):
+        pass
+    with metrics.phase("workbook_create"):
+        blocks = [bytearray(1024) for _ in range(1000)]
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "workbook_create.allocations.txt",
+        "workbook_create.folded",
+        "workbook_create.prof",
+    ]
+    stats = pstats.Stats(str(tmp_path / "workbook_create.prof"))
+    assert stats.total_calls > 0
+    allocations = (tmp_path / "workbook_create.allocations.txt").read_text()
+    assert allocations.startswith("Peak traced memory during workbook_create")
+    assert "test_reporter.py" in allocations
+    # Collapsed stacks, rooted at the thread name
+    folded = (tmp_path / "workbook_create.folded").read_text().splitlines()
+    assert any(
+        line.startswith("MainThread;")
+        and "test_profiler_writes_results_for_chosen_phases" in line
+        and int(line.rsplit(" ", 1)[1]) > 0
+        for line in folded
+    )
+    assert not any("phase-sampler" in line for line in folded)
+    assert len(blocks) == 1000
+    with pytest.raises(ValueError):
+        PhaseProfiler(tmp_path, modes=["perf"])
+
+
+def test_benchmark_times_every_stage():
+    organisation = generate_organisation(people=100, connect_groups=3, seed=3)
+    with FakePCOServer(organisation) as server:
+        pco = pypco.PCO("app-id", "secret", api_base=server.api_base)
+        scheduler = RequestScheduler.install(pco, rate_limit=1000)
+        results = benchmark.run_stages(pco, scheduler)
+    assert list(results) == [
+        "field_definition_mapping",
+        "field_data_processing",
+        "name_population",
+        "workbook_create",
+        "workbook_save",
+        "email_assembly",
+    ]
+    assert results["name_population"]["requests"] == 1
+    assert results["workbook_create"]["requests"] == 0
+
+
+def test_benchmark_compare_flags_regressions_past_threshold():
+    baseline = {"1000": {"workbook_create": {"wall_seconds": 1.0, "requests": 10}}}
+    results = {
+        "1000": {
+            "workbook_create": {"wall_seconds": 1.2, "requests": 13},
+            "email_assembly": {"wall_seconds": 9.0, "requests": 0},
+        },
+        "5000": {"workbook_create": {"wall_seconds": 9.0, "requests": 0}},
+    }
+    assert benchmark.compare(results, baseline, threshold=0.25) == [
+        "1000 people, workbook_create: requests 13 vs baseline 10"
+    ]
+    # Only request counts are compared against another machine's baseline
+    slower = {"1000": {"workbook_create": {"wall_seconds": 9.0, "requests": 10}}}
+    assert len(benchmark.compare(slower, baseline)) == 1
+    assert benchmark.compare(slower, baseline, measures=("requests",)) == []
+    # Too quick for wall time to be compared
+    quick = {"1000": {"workbook_create": {"wall_seconds": 0.01}}}
+    quicker = {"1000": {"workbook_create": {"wall_seconds": 0.001}}}
+    assert benchmark.compare(quick, quicker) == []
+
+
 # ---------------------------------------------------------------------------
 # PersonManager.add_or_extend_attribute
 # ---------------------------------------------------------------------------
@@ -137,11 +949,489 @@ def test_populate_names_deduplicates_across_connect_groups(
 def test_add_or_extend_attribute_sets_first_value():
     pm = PersonManager()
     pm.add_or_extend_attribute("Team", "Worship", 1)
-    assert pm._people[1].personal_attributes["Team"] == "Worship"
+    assert pm._people[1].personal_attributes["Team"] == ["Worship"]
 
 
 def test_add_or_extend_attribute_extends_existing_value():
     pm = PersonManager()
     pm.add_or_extend_attribute("Team", "Worship", 1)
     pm.add_or_extend_attribute("Team", "Kids", 1)
-    assert pm._people[1].personal_attributes["Team"] == "Worship,Kids"
+    assert pm._people[1].personal_attributes["Team"] == ["Worship", "Kids"]
+
+
+def test_volunteer_count_uses_multi_value_attributes(
+    person_manager, connect_group_person_manager
+):
+    connect_group_person_manager.add("", "Alpha CG", 1)
+    connect_group_person_manager.add("", "Alpha CG", 2)
+    person_manager.add_or_extend_attribute("Team", "Worship", 1)
+    person_manager.add_or_extend_attribute("Team", "Kids", 1)
+    person_manager.add_or_extend_attribute("Team", "Worship", 2)
+    assert connect_group_person_manager.volunteer_count == {"Worship": 2, "Kids": 1}
+
+
+def test_multi_value_attribute_joined_when_rendered(person_manager):
+    person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, "Alice", 1)
+    person_manager.add_or_extend_attribute("Team", "Worship", 1)
+    person_manager.add_or_extend_attribute("Team", "Kids", 1)
+    generator = ConnectGroupWorksheetGenerator([PERSONAL_ATTRIBUTE_NAME, "Team"])
+    assert generator.person_as_row_values(person_manager._people[1]) == {
+        1: "Alice",
+        2: "Worship,Kids",
+    }
+
+
+def save_workbook(
+    tmp_path,
+    monkeypatch,
+    membership_manager,
+    write_only=False,
+    processes=1,
+    sheet_cache=None,
+):
+    generator = ConnectGroupWorksheetGenerator(
+        [PERSONAL_ATTRIBUTE_NAME, "Decision Date", "Water Baptism Date", "Team"]
+    )
+    manager = ConnectGroupWorkbookManager(
+        membership_manager, generator, write_only, processes, sheet_cache
+    )
+    manager.create()
+    monkeypatch.setattr(tempfile, "tempdir", tempfile.mkdtemp(dir=tmp_path))
+    return openpyxl.load_workbook(manager.save()), manager
+
+
+@pytest.mark.parametrize(
+    "write_only, processes", [(True, 1), (False, 2)], ids=["write_only", "parallel"]
+)
+def test_streamed_workbook_looks_the_same(
+    tmp_path,
+    monkeypatch,
+    person_manager,
+    connect_group_person_manager,
+    write_only,
+    processes,
+):
+    for pid, name, group in [
+        (1, "Zed", "Beta CG"),
+        (2, "Amy", "Beta CG"),
+        (3, "Bob", "Alpha CG"),
+    ]:
+        person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, name, pid)
+        connect_group_person_manager.add("", group, pid)
+    person_manager.add_attribute("Decision Date", "01/02/2003", 2)
+    person_manager.add_attribute("Water Baptism Date", "04/05/2006", 1)
+    person_manager.add_or_extend_attribute("Team", "Kids", 2)
+    person_manager.add_or_extend_attribute("Team", "Worship", 2)
+
+    cgm = connect_group_person_manager
+    expected, _ = save_workbook(tmp_path, monkeypatch, cgm)
+    actual, _ = save_workbook(tmp_path, monkeypatch, cgm, write_only, processes)
+    assert actual.sheetnames == expected.sheetnames == ["About", "Alpha CG", "Beta CG"]
+    for expected_ws, actual_ws in zip(expected.worksheets, actual.worksheets):
+        assert actual_ws.merged_cells.ranges == expected_ws.merged_cells.ranges
+        assert actual_ws.page_setup.orientation == expected_ws.page_setup.orientation
+        assert actual_ws.page_setup.scale == expected_ws.page_setup.scale
+        for column in "ABCD":
+            assert (
+                actual_ws.column_dimensions[column].width
+                == expected_ws.column_dimensions[column].width
+            )
+        for row in (1, 2, 3):
+            assert (
+                actual_ws.row_dimensions[row].height
+                == expected_ws.row_dimensions[row].height
+            )
+        expected_cells = list(expected_ws.iter_rows())
+        actual_cells = list(actual_ws.iter_rows())
+        assert len(actual_cells) == len(expected_cells)
+        for expected_row, actual_row in zip(expected_cells, actual_cells):
+            for expected_cell, actual_cell in zip(expected_row, actual_row):
+                if expected_ws.title == "About" and expected_cell.coordinate == "B1":
+                    continue  # creation time
+                assert actual_cell.value == expected_cell.value
+                assert actual_cell.style == expected_cell.style
+                # Loaded styles are proxies, which only compare equal by repr
+                for attr in ("font", "fill", "border", "alignment"):
+                    assert repr(getattr(actual_cell, attr)) == repr(
+                        getattr(expected_cell, attr)
+                    )
+
+
+def test_sheet_cache_reuses_unchanged_sheets(
+    tmp_path, monkeypatch, person_manager, connect_group_person_manager
+):
+    for pid, name, group in [
+        (1, "Zed", "Beta CG"),
+        (2, "Amy", "Beta CG"),
+        (3, "Bob", "Alpha CG"),
+    ]:
+        person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, name, pid)
+        connect_group_person_manager.add("", group, pid)
+    cache_dir = tmp_path / "sheets"
+    cache = SheetCache(cache_dir)
+
+    def build():
+        workbook, manager = save_workbook(
+            tmp_path, monkeypatch, connect_group_person_manager, sheet_cache=cache
+        )
+        return workbook, (manager.sheets_reused, manager.sheets_rebuilt)
+
+    uncached, _ = save_workbook(tmp_path, monkeypatch, connect_group_person_manager)
+    assert build()[1] == (0, 2)
+    workbook, counts = build()
+    assert counts == (2, 0)
+    for expected_ws, actual_ws in zip(uncached.worksheets[1:], workbook.worksheets[1:]):
+        assert [[c.value for c in row] for row in actual_ws.iter_rows()] == [
+            [c.value for c in row] for row in expected_ws.iter_rows()
+        ]
+
+    person_manager.add_attribute("Decision Date", "01/02/2003", 3)
+    workbook, counts = build()
+    assert counts == (1, 1)
+    assert workbook["Alpha CG"]["B3"].value == "01/02/2003"
+    # The sheet Alpha CG had before the change is pruned
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+def test_openpyxl_internals():
+    # openpyxl_compat's hooks into openpyxl; if this fails, openpyxl has
+    #  changed them and rendering sheets in other processes will break
+    ws = openpyxl.Workbook(write_only=True).create_sheet("Rendered")
+    ws.append(["Amy"])
+    ws.close()
+    out = ws._writer.out
+    assert out in openpyxl_compat.ALL_TEMP_FILES
+    xml = openpyxl_compat.take_sheet_xml(ws)
+    assert out not in openpyxl_compat.ALL_TEMP_FILES and not os.path.exists(out)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    ws = openpyxl_compat.PrewrittenSheet(workbook, "Copy", xml)
+    openpyxl_compat.add_sheet(workbook, ws)
+    content = io.BytesIO()
+    workbook.save(content)
+    assert not os.path.exists(ws._writer.out)
+    loaded = openpyxl.load_workbook(content)
+    assert loaded.sheetnames == ["Copy"]
+    assert loaded["Copy"]["A1"].value == "Amy"
+
+    # Style ids are positions in the workbook's list of style arrays
+    workbook = openpyxl.Workbook()
+    cell = openpyxl.cell.WriteOnlyCell(workbook.active)
+    cell.font = openpyxl.styles.Font(bold=True)
+    style = openpyxl_compat.cell_style(cell)
+    assert isinstance(style, openpyxl.styles.cell_style.StyleArray)
+    openpyxl_compat.register_cell_style(workbook, style)
+    target = workbook.active["A1"]
+    openpyxl_compat.set_cell_style(target, style)
+    assert target.style_id == 1 and target.font.bold
+
+
+def test_workbook_spooled_at_chosen_compression_level(
+    person_manager, connect_group_person_manager
+):
+    for pid in range(200):
+        person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, f"Person {pid}", pid)
+        connect_group_person_manager.add("", f"CG {pid % 4}", pid)
+    generator = ConnectGroupWorksheetGenerator([PERSONAL_ATTRIBUTE_NAME])
+    sizes = {}
+    for level in (0, 9):
+        manager = ConnectGroupWorkbookManager(
+            connect_group_person_manager, generator, compresslevel=level
+        )
+        manager.create()
+        content = manager.spool().read()
+        sizes[level] = len(content)
+        # openpyxl needs seekable(), which SpooledTemporaryFile lacks before 3.11
+        assert openpyxl.load_workbook(io.BytesIO(content)).sheetnames[0] == "About"
+    assert sizes[9] < sizes[0]
+
+
+def test_attachment_encoded_as_mime_application_would():
+    content = bytes(range(256)) * 1000
+    attachment = app.build_attachment(io.BytesIO(content), "inc_cg.xlsx")
+    expected = MIMEApplication(content)
+    assert attachment.get_payload() == expected.get_payload()
+    assert attachment.get_content_type() == expected.get_content_type()
+    assert attachment["Content-Transfer-Encoding"] == "base64"
+    assert attachment.get_payload(decode=True) == content
+    assert attachment.get_filename() == "inc_cg.xlsx"
+
+
+def test_sheet_styles_resolved_once_per_workbook():
+    generator = ConnectGroupWorksheetGenerator([PERSONAL_ATTRIBUTE_NAME, "Team"])
+    workbook = openpyxl.Workbook()
+    first_ws, second_ws = workbook.active, workbook.create_sheet()
+    styles = generator.styles_for(first_ws)
+    assert generator.styles_for(second_ws) is styles
+    assert generator.styles_for(openpyxl.Workbook().active) is not styles
+
+    cell, other_cell = second_ws["B2"], second_ws["C2"]
+    ConnectGroupStyles.apply(cell, styles.data)
+    ConnectGroupStyles.apply(other_cell, styles.data)
+    assert cell.border == ConnectGroupStyles.THIN_BORDER
+    assert cell.alignment == ConnectGroupStyles.DATA_ALIGNMENT
+    # Cells get their own copy, so restyling one leaves the others alone
+    cell.alignment = ConnectGroupStyles.HEADER_ALIGNMENT
+    assert other_cell.alignment == ConnectGroupStyles.DATA_ALIGNMENT
+
+
+def test_membership_statistics_maintained_incrementally(caplog):
+    caplog.set_level(logging.DEBUG, logger="inc_cg_reporter.connect_group")
+    pm = PersonManager()
+    cgm = ConnectGroupMembershipManager(pm)
+    # Teams arrive both before and after the person joins a group
+    pm.add_or_extend_attribute("Team", "Kids", 1)
+    cgm.add("", "Alpha CG", 1)
+    cgm.add_members_bulk("", [(2, "Alpha CG"), (2, "Beta CG"), (3, "Ghost CG")])
+    pm.add_or_extend_attributes_bulk("Team", [(2, "Worship"), (3, "Kids")])
+    pm.add_or_extend_attribute("Team", "Worship", 1)
+    cgm.verify_statistics()
+    assert cgm.connect_groups_count == 3
+    assert cgm.connect_groups_member_count == 4
+    assert cgm.volunteer_count == {"Kids": 2, "Worship": 3}
+
+    # Person 3 can't be resolved, which empties Ghost CG; the check runs
+    #  automatically at debug level
+    pco = stub(get=lambda *args, **kwargs: make_people_response((1, "A"), (2, "B")))
+    cgm.populate_names_for_people(pco)
+    assert [cg.name for cg in cgm.populated_connect_groups] == ["Alpha CG", "Beta CG"]
+    assert cgm.connect_groups_count == 2
+    assert cgm.connect_groups_member_count == 3
+    assert dict(cgm.volunteer_count) == {"Kids": 1, "Worship": 3}
+
+
+def test_about_sheet_lists_teams_in_member_order(
+    person_manager, connect_group_person_manager
+):
+    for pid, group in [(1, "Alpha CG"), (2, "Beta CG"), (3, "Beta CG")]:
+        person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, f"Person {pid}", pid)
+        connect_group_person_manager.add("", group, pid)
+    # Field data arrives in a different order to the groups' members
+    person_manager.add_or_extend_attribute("Team", "Kids", 2)
+    person_manager.add_or_extend_attribute("Team", "Music", 3)
+    person_manager.add_or_extend_attribute("Team", "Worship", 1)
+    person_manager.add_or_extend_attribute("Team", "Music", 1)
+    connect_group_person_manager.verify_statistics()
+    manager = ConnectGroupWorkbookManager(
+        connect_group_person_manager,
+        ConnectGroupWorksheetGenerator([PERSONAL_ATTRIBUTE_NAME, "Team"]),
+    )
+    manager.create()
+    team_rows = [
+        (label, count)
+        for label, count in manager._workbook["About"].iter_rows(values_only=True)
+        if str(label).startswith("Team size")
+    ]
+    assert team_rows == [
+        ("Team size - Worship:", 1),
+        ("Team size - Music:", 2),
+        ("Team size - Kids:", 1),
+    ]
+
+
+def test_add_is_idempotent(connect_group_person_manager):
+    connect_group_person_manager.add("", "Alpha CG", 1)
+    connect_group_person_manager.add("", "Alpha CG", 1)
+    connect_group_person_manager.add_members_bulk("", [(1, "Alpha CG")])
+    assert len(connect_group_person_manager.connect_groups["Alpha CG"].members) == 1
+    assert connect_group_person_manager.connect_groups_member_count == 1
+
+
+def test_groups_for_person_follows_removal(connect_group_person_manager):
+    connect_group_person_manager.add("", "Beta CG", 1)
+    connect_group_person_manager.add("", "Alpha CG", 1)
+    connect_group_person_manager.add("", "Alpha CG", 2)
+    assert [cg.name for cg in connect_group_person_manager.groups_for_person(1)] == [
+        "Beta CG",
+        "Alpha CG",
+    ]
+
+    connect_group_person_manager._remove_people_from_connect_groups({1})
+    assert connect_group_person_manager.groups_for_person(1) == []
+    assert [
+        m.id for m in connect_group_person_manager.connect_groups["Alpha CG"].members
+    ] == [2]
+    assert connect_group_person_manager.connect_groups_count == 1
+
+
+def test_membership_statistics_inconsistency_detected(connect_group_person_manager):
+    connect_group_person_manager.add("", "Alpha CG", 1)
+    connect_group_person_manager.connect_groups["Alpha CG"].member_by_id.clear()
+    with pytest.raises(RuntimeError):
+        connect_group_person_manager.verify_statistics()
+
+
+# ---------------------------------------------------------------------------
+# Person attribute storage
+# ---------------------------------------------------------------------------
+
+
+def test_personal_attributes_view_behaves_like_a_dict():
+    pm = PersonManager()
+    pm.add_attribute("Decision Date", "01/01/2020", 1)
+    pm.add_attribute("Name", "Alice", 1)
+    pm.add_attribute("Encounter Date", None, 1)
+    pm.add_attribute("Name", "Bob", 2)
+    alice = pm._people[1].personal_attributes
+
+    assert dict(alice) == {
+        "Decision Date": "01/01/2020",
+        "Name": "Alice",
+        "Encounter Date": None,
+    }
+    assert "Encounter Date" in alice and "Team" not in alice
+    assert alice.get("Team", "") == ""
+    del alice["Decision Date"]
+    assert len(alice) == 2
+    assert dict(pm._people[2].personal_attributes) == {"Name": "Bob"}
+
+
+def test_people_share_one_attribute_schema():
+    pm = PersonManager()
+    pm.add_attribute("Name", "Alice", 1)
+    pm.add_attribute("Name", "Bob", 2)
+    assert pm._people[1].schema is pm._people[2].schema
+    # People compare by their attributes, whatever schema they use
+    alice = Person(1)
+    alice.set_attribute("Name", "Alice")
+    assert pm._people[1] == alice
+    assert not hasattr(pm._people[1], "__dict__")
+
+
+# ---------------------------------------------------------------------------
+# Email delivery
+# ---------------------------------------------------------------------------
+
+
+def test_deliver_retries_dropped_messages_over_pooled_connections():
+    messages = []
+    for n in range(12):
+        msg = MIMEText(f"Message {n}")
+        msg["Subject"] = f"Message {n}"
+        msg["From"] = "reports@example.com"
+        msg["To"] = f"leader{n}@example.com"
+        messages.append(msg)
+
+    with FakeSMTPServer(drop_every=5) as server:
+        pool = SMTPPool(*server.address, "user", "password", size=2, starttls=False)
+        stats = deliver(pool, messages, retry_delay=0)
+        pool.close()
+
+    assert (stats.sent, stats.failed) == (12, 0)
+    assert server.dropped == 2
+    assert sorted(m.message["Subject"] for m in server.messages) == sorted(
+        m["Subject"] for m in messages
+    )
+    # Connections are only replaced when a message is dropped
+    assert pool.connections_opened == server.connections <= 2 + server.dropped
+
+
+def test_run_fails_when_report_email_is_not_delivered(tmp_path, monkeypatch):
+    organisation = generate_organisation(people=50, connect_groups=2, seed=4)
+    with FakePCOServer(organisation) as pco_server, FakeSMTPServer(
+        drop_every=1
+    ) as smtp_server:
+        smtp_host, smtp_port = smtp_server.address
+        monkeypatch.setenv("RUN_REPORT_FILE", str(tmp_path / "run.json"))
+        monkeypatch.setenv("PCO_API_BASE", pco_server.api_base)
+        monkeypatch.setenv("PC_APPLICATION_ID", "app-id")
+        monkeypatch.setenv("PC_SECRET", "secret")
+        monkeypatch.setenv("EMAIL_FROM", "reports@example.com")
+        monkeypatch.setenv("EMAIL_TO", "leaders@example.com")
+        monkeypatch.setenv("SMTP_HOST", smtp_host)
+        monkeypatch.setenv("SMTP_PORT", str(smtp_port))
+        monkeypatch.setenv("SMTP_STARTTLS", "false")
+        monkeypatch.setenv("SMTP_MAX_ATTEMPTS", "1")
+        monkeypatch.delenv("SEND_EMAIL", raising=False)
+        monkeypatch.delenv("CACHE_DIR", raising=False)
+        monkeypatch.delenv("LEADER_EMAILS_FILE", raising=False)
+        with pytest.raises(RuntimeError):
+            app.run()
+    assert smtp_server.dropped == 1
+    report = json.loads((tmp_path / "run.json").read_text())
+    assert not report["succeeded"]
+    assert "email" in report["phases"]
+
+
+def test_leaders_are_sent_their_own_group_sheet(
+    monkeypatch, caplog, person_manager, connect_group_person_manager
+):
+    for pid, name, group in [
+        (1, "Zed", "Beta CG"),
+        (2, "Amy", "Beta CG"),
+        (3, "Bob", "Alpha CG"),
+        (4, "Cat", "Gamma CG"),
+    ]:
+        person_manager.add_attribute(PERSONAL_ATTRIBUTE_NAME, name, pid)
+        connect_group_person_manager.add("", group, pid)
+    monkeypatch.setenv("EMAIL_FROM", "reports@example.com")
+    manager = ConnectGroupWorkbookManager(
+        connect_group_person_manager,
+        ConnectGroupWorksheetGenerator([PERSONAL_ATTRIBUTE_NAME]),
+        processes=2,
+    )
+    leader_emails = {
+        "Alpha CG": ["alpha@example.com"],
+        "Beta CG": ["beta1@example.com", "beta2@example.com"],
+        "Delta CG": ["typo@example.com"],
+    }
+
+    with FakeSMTPServer() as server:
+        pool = SMTPPool(*server.address, starttls=False)
+        stats = app.send_leader_emails(manager, leader_emails, pool)
+        pool.close()
+
+    assert stats.sent == 2
+    assert [r.levelname for r in caplog.records if "Delta CG" in r.getMessage()] == [
+        "WARNING"
+    ]
+    received = {tuple(m.recipients): m.message for m in server.messages}
+    assert set(received) == {
+        ("alpha@example.com",),
+        ("beta1@example.com", "beta2@example.com"),
+    }
+    beta = received[("beta1@example.com", "beta2@example.com")]
+    attachment = next(part for part in beta.walk() if part.get_filename())
+    workbook = openpyxl.load_workbook(io.BytesIO(attachment.get_payload(decode=True)))
+    assert workbook.sheetnames == ["Beta CG"]
+    assert [c.value for c in workbook["Beta CG"]["A"]] == [
+        "Beta CG",
+        "Name",
+        "Amy",
+        "Zed",
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Startup
+# ---------------------------------------------------------------------------
+
+# Loaded by the phases that need them, never by importing the app
+LAZILY_IMPORTED_MODULES = [
+    "dotenv",
+    "email.mime.multipart",
+    "more_itertools",
+    "openpyxl",
+    "pypco",
+    "requests",
+    "smtplib",
+    "sqlite3",
+]
+# Microseconds; it's about 90ms here, 55ms of which is daiquiri
+APP_IMPORT_BUDGET = 250_000
+
+
+def test_app_import_stays_within_budget():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import inc_cg_reporter.app"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines are "import time: <self us> | <cumulative us> | <indented name>"
+    cumulative = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative_us, name = line.split("|")
+        cumulative[name.strip()] = int(cumulative_us)
+    assert [name for name in LAZILY_IMPORTED_MODULES if name in cumulative] == []
+    assert cumulative["inc_cg_reporter.app"] < APP_IMPORT_BUDGET